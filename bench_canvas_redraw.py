@@ -0,0 +1,94 @@
+"""
+Micro-benchmark: full canvas redraw vs. incremental CanvasScene update.
+
+Simulates saving one more box on an image that already has N boxes:
+  - full:        canvas.delete("all"), re-create the background and every box
+                 (what display_image did before CanvasScene)
+  - incremental: CanvasScene.sync() with the new box added
+
+Needs a display. Run with:  python bench_canvas_redraw.py
+"""
+import random
+import statistics
+import time
+import tkinter as tk
+
+from PIL import Image, ImageTk
+
+from test_6_annotation_tool_6 import CanvasScene
+
+BOX_COUNTS = [10, 50, 100, 200, 400, 800]
+REPEATS = 20
+
+
+def make_boxes(count, width, height):
+    boxes = {}
+    for i in range(count):
+        x0 = random.randint(0, width - 60)
+        y0 = random.randint(15, height - 60)
+        boxes[i] = ((x0, y0, x0 + random.randint(20, 60), y0 + random.randint(20, 60)),
+                    f"crop | disease | name {i} | leaf")
+    return boxes
+
+
+def full_redraw(canvas, photo, boxes):
+    canvas.delete("all")
+    canvas.create_image(0, 0, anchor="nw", image=photo)
+    for (x0, y0, x1, y1), label in boxes.values():
+        canvas.create_rectangle(x0, y0, x1, y1, outline='red', width=2)
+        canvas.create_text(x0 + 5, y0 - 15, anchor="nw", fill="red", text=label, font=('Arial', 10, 'bold'))
+    canvas.update_idletasks()
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    root = tk.Tk()
+    width, height = 1260, 700
+    canvas = tk.Canvas(root, width=width, height=height)
+    canvas.pack()
+    photo = ImageTk.PhotoImage(Image.new("RGB", (width, height), (90, 140, 60)))
+    root.update()
+
+    print(f"{'boxes':>6} | {'full (ms)':>10} | {'incremental (ms)':>16} | {'speed-up':>8}")
+    print("-" * 50)
+    for count in BOX_COUNTS:
+        boxes = make_boxes(count, width, height)
+        new_box = make_boxes(1, width, height)[0]
+
+        full_times = []
+        for _ in range(REPEATS):
+            full_redraw(canvas, photo, boxes)
+            with_new = dict(boxes)
+            with_new[count] = new_box
+            full_times.append(timed(lambda: full_redraw(canvas, photo, with_new)))
+
+        canvas.delete("all")
+        scene = CanvasScene(canvas)
+        scene.set_background(photo)
+        incremental_times = []
+        for _ in range(REPEATS):
+            scene.sync(boxes)
+            canvas.update_idletasks()
+            with_new = dict(boxes)
+            with_new[count] = new_box
+
+            def incremental():
+                scene.sync(with_new)
+                canvas.update_idletasks()
+            incremental_times.append(timed(incremental))
+        canvas.delete("all")
+
+        full_ms = statistics.median(full_times)
+        incremental_ms = statistics.median(incremental_times)
+        print(f"{count:>6} | {full_ms:>10.2f} | {incremental_ms:>16.3f} | {full_ms / max(incremental_ms, 1e-6):>7.0f}x")
+
+    root.destroy()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,77 +4,684 @@ from PIL import Image, ImageTk
 import cv2
 import shutil
 
+import bisect
 import os
 import numpy as np
 import json
 from tkinter import messagebox
 from copy import deepcopy
 import threading
+from collections import OrderedDict, deque
 from datetime import datetime
+class SuggestionIndex:
+    """Lowercase lookup structures for a suggestion vocabulary.
+
+    Prefix matches come from bisecting the sorted lowercase list; substring
+    matches from a trigram index, intersected and then verified (patterns
+    shorter than a trigram are a plain scan). Popups with the same vocabulary
+    share one index; an index is never changed once built.
+    """
+    GRAM = 3
+    _shared = OrderedDict()
+
+    def __init__(self, items=()):
+        self.items = sorted(set(items), key=lambda item: (item.lower(), item))
+        self.lowered = [item.lower() for item in self.items]
+        self.grams = {}  # trigram -> set of items
+        for item, text in zip(self.items, self.lowered):
+            self._index_grams(item, text)
+
+    def _index_grams(self, item, text):
+        for start in range(len(text) - self.GRAM + 1):
+            self.grams.setdefault(text[start:start + self.GRAM], set()).add(item)
+
+    @classmethod
+    def shared(cls, items):
+        wanted = frozenset(items)
+        if wanted in cls._shared:
+            cls._shared.move_to_end(wanted)
+            return cls._shared[wanted]
+        index = cls(wanted)
+        cls._shared[wanted] = index
+        if len(cls._shared) > 8:
+            cls._shared.popitem(last=False)
+        return index
+
+    def search(self, pattern, limit):
+        """Up to limit items containing pattern: prefix matches first, then by match position."""
+        pattern = pattern.lower()
+        if not pattern:
+            return self.items[:limit]
+
+        results = []
+        position = bisect.bisect_left(self.lowered, pattern)
+        while position < len(self.lowered) and self.lowered[position].startswith(pattern) and len(results) < limit:
+            results.append(self.items[position])
+            position += 1
+        if len(results) >= limit:
+            return results
+
+        if len(pattern) < self.GRAM:
+            candidates = [item for item, text in zip(self.items, self.lowered) if pattern in text]
+        else:
+            postings = sorted((self.grams.get(pattern[i:i + self.GRAM], set())
+                               for i in range(len(pattern) - self.GRAM + 1)), key=len)
+            candidates = set.intersection(*postings)
+        prefixed = set(results)
+        ranked = sorted((item.lower().find(pattern), item.lower(), item)
+                        for item in candidates if item not in prefixed)
+        for found_at, _, item in ranked:
+            if found_at < 0:
+                continue  # trigrams matched out of order
+            results.append(item)
+            if len(results) >= limit:
+                break
+        return results
+
+
 class AutoCompleteEntry(tk.Entry):
+    MAX_RESULTS = 20
+    DEBOUNCE_MS = 120
+
     def __init__(self, master, suggestion_list, *args, **kwargs):
         super().__init__(master, *args, **kwargs)
         self.master = master
         self.suggestion_list = sorted(suggestion_list)
+        self.index = SuggestionIndex.shared(self.suggestion_list)
         self.var = self["textvariable"] = tk.StringVar()
         self.var.trace_add("write", self.changed)
         self.bind("<Down>", self.move_down)
         self.bind("<Return>", self.select_item)
         self.bind("<Right>", self.select_item)
-        self.bind("<FocusOut>", lambda e: self.hide_listbox())
-        
+        self.bind("<FocusOut>", lambda e: self.after_idle(self.hide_unless_focused))
 
-        self.listbox = None
+        self.listbox = None  # created once, then refilled and re-placed
+        self.shown = []
+        self.pending_search = None
 
     def changed(self, *args):
-        pattern = self.var.get().lower()
-        matches = [item for item in self.suggestion_list if pattern in item.lower()]
-        self.show_matches(matches)
+        # Search once typing pauses instead of on every keystroke
+        if self.pending_search is not None:
+            self.after_cancel(self.pending_search)
+        self.pending_search = self.after(self.DEBOUNCE_MS, self.update_matches)
 
-    def show_matches(self, matches):
-        if self.listbox:
-            self.listbox.destroy()
+    def update_matches(self):
+        self.pending_search = None
+        self.show_matches(self.index.search(self.var.get(), self.MAX_RESULTS))
 
+    def show_matches(self, matches):
         if not matches:
+            self.hide_listbox()
             return
 
-        self.listbox = tk.Listbox(self.master, height=min(5, len(matches)))
-        self.listbox.bind("<<ListboxSelect>>", self.on_listbox_select)
-
-        for match in matches:
-            self.listbox.insert(tk.END, match)
-
-        self.listbox.place(x= self.winfo_rootx() - self.master.winfo_rootx(),
-                           y= self.winfo_rooty() - self.master.winfo_rooty() + self.winfo_height(),
+        if self.listbox is None:
+            self.listbox = tk.Listbox(self.master)
+            self.listbox.bind("<<ListboxSelect>>", self.on_listbox_select)
+
+        # Only rewrite the rows after the first difference
+        common = 0
+        while common < min(len(matches), len(self.shown)) and matches[common] == self.shown[common]:
+            common += 1
+        if common < len(self.shown):
+            self.listbox.delete(common, tk.END)
+        if common < len(matches):
+            self.listbox.insert(tk.END, *matches[common:])
+        self.shown = list(matches)
+
+        self.listbox.config(height=min(5, len(matches)))
+        self.listbox.place(x=self.winfo_rootx() - self.master.winfo_rootx(),
+                           y=self.winfo_rooty() - self.master.winfo_rooty() + self.winfo_height(),
                            width=self.winfo_width())
 
     def hide_listbox(self):
         if self.listbox:
-            self.listbox.destroy()
-            self.listbox = None
+            self.listbox.place_forget()
+
+    def hide_unless_focused(self):
+        if self.listbox is None or self.focus_get() is not self.listbox:
+            self.hide_listbox()
 
     def on_listbox_select(self, event):
         if self.listbox:
             index = self.listbox.curselection()
             if index:
-                self.var.set(self.listbox.get(index))
-                self.hide_listbox()
+                self.pick(self.listbox.get(index))
 
     def select_item(self, event):
         if self.listbox:
             index = self.listbox.curselection()
             if index:
-                self.var.set(self.listbox.get(index))
+                self.pick(self.listbox.get(index))
         self.hide_listbox()
 
+    def pick(self, value):
+        """Take a suggestion; the search its trace schedules is cancelled so the list stays hidden."""
+        self.var.set(value)
+        self.cancel_search()
+        self.hide_listbox()
+
+    def cancel_search(self):
+        if self.pending_search is not None:
+            self.after_cancel(self.pending_search)
+            self.pending_search = None
+
     def move_down(self, event):
-        if self.listbox:
+        if self.listbox and self.shown:
             self.listbox.focus_set()
             self.listbox.selection_set(0)
     def add_suggestion(self, new_item):
         if new_item not in self.suggestion_list:
             self.suggestion_list.append(new_item)
             self.suggestion_list.sort()
+            self.index = SuggestionIndex.shared(self.suggestion_list)
+
+
+class AnnotationStore:
+    """annotations.json keyed by image path, updated through an append-only patch log.
+
+    Every save appends one JSON line holding the full record of a single image
+    to annotations.json.patch, so a box change costs one small write. The patch
+    log is folded into annotations.json (one record per path, last write wins)
+    by compact(), on leaving the project, or on a background thread once the
+    log gets long. Compaction first renames the log to .patch.compacting, so
+    saves made meanwhile go to a fresh log, and swaps the rewritten file in
+    with os.replace.
+
+    compact() also writes annotations.json.idx with the byte offset, length and
+    label counts of every record, so opening one folder of a large shared file
+    reads only the index and then single records as images are shown.
+    """
+    BOX_FIELDS = ("x0", "y0", "x1", "y1", "crop", "category", "name", "stage")
+    COMPACT_AFTER = 500
+
+    def __init__(self, json_path):
+        self.json_path = json_path
+        self.patch_path = json_path + ".patch"
+        self.compacting_path = self.patch_path + ".compacting"  # log being folded in (or left by a crash)
+        self.index_path = json_path + ".idx"
+        self.pending = 0
+        self.stamp = None  # (size, mtime_ns) of annotations.json that the index describes
+        self.log_lock = threading.Lock()  # patch appends vs. the rename that freezes the log
+        self.compact_lock = threading.Lock()
+        self.compactor = None
+        self.next_ids = {}  # path -> next box id; stored with each record so ids are never handed out twice
+        for log_path in (self.compacting_path, self.patch_path):
+            if os.path.exists(log_path):
+                with open(log_path, 'r') as f:
+                    self.pending += sum(1 for line in f if line.strip())
+        self.entries = self.read_index()  # path -> [offset, length, {label: count}]
+        if self.entries is None and not os.path.exists(self.json_path):
+            self.entries = {}
+
+    def read_index(self):
+        """Record offsets for annotations.json, or None if the sidecar is missing or stale."""
+        if not os.path.exists(self.index_path) or not os.path.exists(self.json_path):
+            return None
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        stamp = (index.get("size"), index.get("mtime_ns"))
+        if stamp != self.file_stamp():
+            return None  # annotations.json was changed by something else
+        self.stamp = stamp
+        return index["entries"]
+
+    def file_stamp(self):
+        try:
+            stat = os.stat(self.json_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def upsert(self, rel_path, annotations):
+        """Replace the record for one image; annotations=None removes it."""
+        boxes = None
+        if annotations is not None:
+            boxes = [dict(zip(self.BOX_FIELDS, ann), box_id=box_id) for box_id, ann in annotations.items()]
+        record = {"path": rel_path, "bounding_and_label": boxes}
+        if rel_path in self.next_ids:
+            record["next_box_id"] = self.next_ids[rel_path]
+        with self.log_lock:
+            with open(self.patch_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+            self.pending += 1
+        if self.pending >= self.COMPACT_AFTER and (self.compactor is None or not self.compactor.is_alive()):
+            # Rewriting the whole file takes a while; keep it off the Tk thread
+            self.compactor = threading.Thread(target=self.compact, daemon=True)
+            self.compactor.start()
+
+    def load_patch(self, live=True):
+        """Return {path: boxes or None} from the patch log, last write wins.
+
+        live=False reads only the log frozen for compaction.
+        """
+        patch = OrderedDict()
+        for log_path in (self.compacting_path, self.patch_path) if live else (self.compacting_path,):
+            if not os.path.exists(log_path):
+                continue
+            with open(log_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn last line after a crash
+                    patch[entry["path"]] = entry["bounding_and_label"]
+                    self.note_next_id(entry)
+        return patch
+
+    def note_next_id(self, record):
+        """Keep the highest next box id seen for a record's path."""
+        if record.get("next_box_id") is not None:
+            path = record["path"]
+            self.next_ids[path] = max(self.next_ids.get(path, 0), record["next_box_id"])
+
+    @classmethod
+    def to_annotations(cls, boxes):
+        """{box id: (x0, y0, x1, y1, crop, category, name, stage)} from stored box dicts."""
+        return {
+            box.get("box_id", position): tuple(box[field] for field in cls.BOX_FIELDS)
+            for position, box in enumerate(boxes, start=1)
+        }
+
+    def read_boxes(self, path):
+        """Read one record's boxes straight from its offset in annotations.json.
+
+        Another instance may have compacted the shared file since the index was
+        read, so the stamp is checked first and the index reloaded if it moved;
+        a record that does not decode to this path falls back to a full read.
+        """
+        if self.entries is None or self.stamp != self.file_stamp():
+            self.entries = self.read_index()
+        if self.entries is not None and path in self.entries:
+            offset, length = self.entries[path][:2]
+            with open(self.json_path, 'rb') as f:
+                f.seek(offset)
+                try:
+                    record = json.loads(f.read(length).decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    record = None
+            if isinstance(record, dict) and record.get("path") == path:
+                self.note_next_id(record)
+                return record["bounding_and_label"]
+        for record_path, boxes in self.scan_records():
+            if record_path == path:
+                return boxes
+        return []
+
+    def base_records(self):
+        if self.entries is not None and self.stamp != self.file_stamp():
+            self.entries = self.read_index()
+        if self.entries is not None:
+            for path in list(self.entries):
+                yield path, self.read_boxes(path)
+            return
+        yield from self.scan_records()
+
+    def scan_records(self):
+        """(path, boxes) for every record, parsing the whole of annotations.json."""
+        records = OrderedDict()
+        if not os.path.exists(self.json_path):
+            return
+        if os.path.getsize(self.json_path) > 0:
+            try:
+                with open(self.json_path, 'r') as f:
+                    json_data = json.load(f)
+            except json.JSONDecodeError:
+                json_data = {}
+            for key in sorted(json_data, key=lambda k: int(k) if str(k).isdigit() else 0):
+                entry = json_data[key]
+                # Older versions appended the same image again on every save
+                records.pop(entry["path"], None)
+                records[entry["path"]] = entry.get("bounding_and_label", [])
+                self.note_next_id(entry)
+        yield from records.items()
+
+    def iter_records(self, patch=None):
+        """Yield (path, boxes) for every image with the patch log applied, one record at a time."""
+        patch = self.load_patch() if patch is None else patch
+        for path, boxes in self.base_records():
+            if path in patch:
+                boxes = patch.pop(path)
+            if boxes is not None:
+                yield path, boxes
+        for path, boxes in patch.items():
+            if boxes is not None:
+                yield path, boxes
+
+    def load_folder(self, prefix):
+        """Return ({path: boxes} from the patch log, {path: {label: count}} left on disk) under prefix."""
+        if self.entries is None:
+            self.compact()  # one full pass to build the sidecar index
+        patch = self.load_patch()
+        loaded = {path: boxes for path, boxes in patch.items() if path.startswith(prefix) and boxes is not None}
+        on_disk = {
+            path: entry[2] for path, entry in self.entries.items()
+            if path.startswith(prefix) and path not in patch
+        }
+        return loaded, on_disk
+
+    def compact(self):
+        """Rewrite annotations.json from the merged records, refresh the index and drop the patch log."""
+        with self.compact_lock:
+            self._compact()
+
+    def _compact(self):
+        with self.log_lock:
+            if not self.pending and self.entries is not None:
+                return
+            # Freeze the log; saves from here on go to a fresh .patch
+            if os.path.exists(self.patch_path):
+                if os.path.exists(self.compacting_path):
+                    with open(self.patch_path, 'r') as src, open(self.compacting_path, 'a') as dst:
+                        dst.write(src.read())
+                    os.remove(self.patch_path)
+                else:
+                    os.replace(self.patch_path, self.compacting_path)
+            self.pending = 0
+        entries = {}
+        box_index = 1
+        tmp_path = self.json_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b"{")
+            for image_index, (path, boxes) in enumerate(self.iter_records(self.load_patch(live=False)), start=1):
+                entry = {"path": path, "bounding_and_label": []}
+                label_counts = {}
+                for box in boxes:
+                    record = dict({"index": box_index}, **{field: box[field] for field in self.BOX_FIELDS})
+                    if "box_id" in box:
+                        record["box_id"] = box["box_id"]
+                    entry["bounding_and_label"].append(record)
+                    label = f"{box['crop']}:{box['category']}"
+                    label_counts[label] = label_counts.get(label, 0) + 1
+                    box_index += 1
+                if path in self.next_ids:
+                    entry["next_box_id"] = self.next_ids[path]
+                # Same layout as json.dump(..., indent=4), but with each record's offset known
+                f.write((b"\n" if image_index == 1 else b",\n") + f'    "{image_index}": '.encode('utf-8'))
+                data = json.dumps(entry, indent=4).replace("\n", "\n    ").encode('utf-8')
+                entries[path] = [f.tell(), len(data), label_counts]
+                f.write(data)
+            f.write(b"\n}" if entries else b"}")
+        os.replace(tmp_path, self.json_path)
+
+        stat = os.stat(self.json_path)
+        with open(self.index_path + ".tmp", 'w') as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "entries": entries}, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+        self.entries = entries
+        self.stamp = (stat.st_size, stat.st_mtime_ns)
+
+
+class LazyAnnotations(dict):
+    """Annotation dict that reads an image's boxes from annotations.json on first access."""
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.unloaded = {}  # filename -> (record path, {label: count})
+
+    def __missing__(self, filename):
+        if filename not in self.unloaded:
+            raise KeyError(filename)
+        path, _ = self.unloaded.pop(filename)
+        boxes = AnnotationStore.to_annotations(self.store.read_boxes(path))
+        dict.__setitem__(self, filename, boxes)
+        return boxes
+
+    def __contains__(self, filename):
+        return dict.__contains__(self, filename) or filename in self.unloaded
+
+    def __setitem__(self, filename, boxes):
+        self.unloaded.pop(filename, None)
+        dict.__setitem__(self, filename, boxes)
+
+    def __delitem__(self, filename):
+        if filename not in self:
+            raise KeyError(filename)
+        self.unloaded.pop(filename, None)
+        dict.pop(self, filename, None)
+
+    def get(self, filename, default=None):
+        try:
+            return self[filename]
+        except KeyError:
+            return default
+
+    def label_counts(self):
+        """{"crop:category": count} without loading records that are still on disk."""
+        counts = {}
+        for anns in dict.values(self):
+            for ann in anns.values():
+                label = f"{ann[4]}:{ann[5]}"
+                counts[label] = counts.get(label, 0) + 1
+        for _, labels in self.unloaded.values():
+            for label, count in labels.items():
+                counts[label] = counts.get(label, 0) + count
+        return counts
+
+
+class HistoryShard:
+    """Undo/redo history for one folder, kept in .history/<folder>.jsonl.
+
+    Actions live in per-image stacks and carry a global sequence number, so
+    undo/redo on the shown image pops that image's stack directly. Each change
+    appends one line (push, pop of an image's last action, or clear), so an
+    action writes only its own folder's shard. The undo history is capped at
+    MAX_DEPTH, oldest action first; once the log holds many more lines than
+    the stacks do, a background thread rewrites the shard as plain pushes.
+    """
+    MAX_DEPTH = 200
+
+    def __init__(self, history_dir, folder_key, legacy_files=None):
+        os.makedirs(history_dir, exist_ok=True)
+        self.path = os.path.join(history_dir, f"{folder_key}.jsonl")
+        self.lock = threading.Lock()
+        self.stacks = {"undo": {}, "redo": {}}  # stack -> {filename: [action, ...]}, oldest first
+        self.order = {"undo": deque(), "redo": deque()}  # (seq, filename) in push order
+        self.counts = {"undo": 0, "redo": 0}
+        self.seq = 0
+        self.log_lines = 0
+        self.trimming = False
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn last line after a crash
+                    self.apply(entry)
+                    self.log_lines += 1
+        elif legacy_files:
+            # Seed the shard from the old undo_stack.json / redo_stack.json
+            for name, legacy_path in zip(("undo", "redo"), legacy_files):
+                if os.path.exists(legacy_path):
+                    try:
+                        with open(legacy_path, 'r') as f:
+                            data = json.load(f)
+                    except (OSError, json.JSONDecodeError):
+                        continue
+                    if isinstance(data, dict):
+                        actions = data.get(folder_key, [])
+                    else:  # one list for every folder
+                        actions = [action for action in data if isinstance(action, dict) and os.path.basename(
+                            os.path.dirname(action.get("source_image_path", ""))) == folder_key]
+                    for action in actions:
+                        if isinstance(action, dict) and "filename" in action:
+                            self.apply({"op": "push", "stack": name, "action": action})
+            if self.counts["undo"] or self.counts["redo"]:
+                self.rewrite()
+
+    def apply(self, entry):
+        name = entry["stack"]
+        stacks = self.stacks[name]
+        if entry["op"] == "push":
+            action = dict(entry["action"])
+            # JSON turns the annotation tuples into lists
+            if action.get("annotation") is not None:
+                action["annotation"] = tuple(action["annotation"])
+            if action.get("annotations") is not None:
+                action["annotations"] = [tuple(ann) for ann in action["annotations"]]
+            if action.get("boxes") is not None:
+                action["boxes"] = [[box_id, tuple(ann)] for box_id, ann in action["boxes"]]
+            if action.get("seq") is None:
+                action["seq"] = self.seq + 1
+            self.seq = max(self.seq, action["seq"])
+            stacks.setdefault(action["filename"], []).append(action)
+            self.order[name].append((action["seq"], action["filename"]))
+            self.counts[name] += 1
+            if name == "undo" and self.counts[name] > self.MAX_DEPTH:
+                self.drop_oldest(name)
+        elif entry["op"] == "pop":
+            if "pos" in entry:
+                # Shards written before per-image stacks popped by position in one list
+                flat = sorted((action for actions in stacks.values() for action in actions),
+                              key=lambda action: action["seq"])
+                if not 0 <= entry["pos"] < len(flat):
+                    return
+                filename = flat[entry["pos"]]["filename"]
+                stacks[filename].remove(flat[entry["pos"]])
+            else:
+                filename = entry["filename"]
+                if not stacks.get(filename):
+                    return
+                stacks[filename].pop()
+            if not stacks[filename]:
+                del stacks[filename]
+            self.counts[name] -= 1
+        elif entry["op"] == "clear":
+            stacks.clear()
+            self.order[name].clear()
+            self.counts[name] = 0
+
+    def drop_oldest(self, name):
+        stacks = self.stacks[name]
+        while self.order[name]:
+            seq, filename = self.order[name].popleft()
+            actions = stacks.get(filename)
+            if actions and actions[0]["seq"] == seq:
+                actions.pop(0)
+                if not actions:
+                    del stacks[filename]
+                self.counts[name] -= 1
+                return
+
+    def record(self, entry):
+        with self.lock:
+            self.apply(entry)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+            self.log_lines += 1
+            total = self.counts["undo"] + self.counts["redo"]
+            needs_trim = (self.log_lines > 4 * total + self.MAX_DEPTH
+                          or sum(len(order) for order in self.order.values()) > 4 * total + self.MAX_DEPTH)
+        if needs_trim and not self.trimming:
+            self.trimming = True
+            threading.Thread(target=self.trim, daemon=True).start()
+
+    def push(self, name, action):
+        """Push action onto its image's stack with a fresh sequence number."""
+        action["seq"] = self.seq + 1
+        self.record({"op": "push", "stack": name, "action": action})
+
+    def peek(self, name, filename):
+        actions = self.stacks[name].get(filename)
+        return actions[-1] if actions else None
+
+    def pop(self, name, filename):
+        """Pop the latest action for one image, or None."""
+        action = self.peek(name, filename)
+        if action is not None:
+            self.record({"op": "pop", "stack": name, "filename": filename})
+        return action
+
+    def clear(self, name):
+        if self.counts[name]:
+            self.record({"op": "clear", "stack": name})
+
+    def rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for name in ("undo", "redo"):
+                actions = sorted((action for actions in self.stacks[name].values() for action in actions),
+                                 key=lambda action: action["seq"])
+                self.order[name] = deque((action["seq"], action["filename"]) for action in actions)
+                for action in actions:
+                    f.write(json.dumps({"op": "push", "stack": name, "action": action}) + "\n")
+        os.replace(tmp_path, self.path)
+        self.log_lines = self.counts["undo"] + self.counts["redo"]
+
+    def trim(self):
+        try:
+            with self.lock:
+                self.rewrite()
+        except OSError as e:
+            print(f"Could not trim history {self.path}: {e}")
+        finally:
+            self.trimming = False
+
+
+class ViewTransform:
+    """Maps source-pixel boxes to canvas coordinates and back: canvas = source * zoom.
+
+    The image is drawn at the canvas origin (scrolling is handled through
+    canvasx/canvasy), so the map is a pure scale. Boxes go through as an
+    (N, 4) array so drawing and hit-testing map every box in one operation.
+    """
+    def __init__(self, scale=1.0):
+        self.scale = float(scale)
+
+    def to_view(self, boxes):
+        return np.asarray(boxes, dtype=float).reshape(-1, 4) * self.scale
+
+    def to_stored(self, boxes):
+        return np.asarray(boxes, dtype=float).reshape(-1, 4) / self.scale
+
+
+class ImagePyramid:
+    """Multi-resolution tile pyramid for one image.
+
+    Level k holds the source at 1/2**k. Display tiles are cut from the coarsest
+    level that still has at least screen resolution, so rendering cost depends
+    on the visible area only, not on the zoom level.
+    """
+    TILE_SIZE = 256
+
+    def __init__(self, path):
+        self.path = path
+        with Image.open(path) as img:
+            base = img.convert("RGB")
+        self.size = base.size
+        self.levels = [base]
+        while max(self.levels[-1].size) > self.TILE_SIZE:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    def level_for_zoom(self, zoom):
+        level = 0
+        while level + 1 < len(self.levels) and 0.5 ** (level + 1) >= zoom:
+            level += 1
+        return level
+
+    def zoomed_size(self, zoom):
+        return max(1, int(self.size[0] * zoom)), max(1, int(self.size[1] * zoom))
+
+    def render_tile(self, zoom, col, row):
+        """Return display tile (col, row) at the given zoom as a PIL image."""
+        zoomed_width, zoomed_height = self.zoomed_size(zoom)
+        x0, y0 = col * self.TILE_SIZE, row * self.TILE_SIZE
+        x1 = min(x0 + self.TILE_SIZE, zoomed_width)
+        y1 = min(y0 + self.TILE_SIZE, zoomed_height)
+
+        level = self.level_for_zoom(zoom)
+        source = self.levels[level]
+        factor = (0.5 ** level) / zoom  # level pixels per display pixel
+        box = (x0 * factor, y0 * factor,
+               min(x1 * factor, source.width), min(y1 * factor, source.height))
+        return source.resize((x1 - x0, y1 - y0), Image.BILINEAR, box=box)
+
 
 class AnnotationTool:
     def __init__(self, root):
@@ -93,6 +700,8 @@ class AnnotationTool:
         self.selected_target_folder=None
         self.undo_file = os.path.join(os.path.dirname(__file__), "undo_stack.json")
         self.redo_file = os.path.join(os.path.dirname(__file__), "redo_stack.json")
+        self.history_dir = os.path.join(os.path.dirname(__file__), ".history")
+        self.history = None  # HistoryShard for the open folder
         
 
         self.last_crop = ""
@@ -100,21 +709,20 @@ class AnnotationTool:
         self.last_name = ""
         self.source_folder = None
         self.target_folder = None
-        self.undo_stack = []  # List of (filename, annotation) tuples
-        self.redo_stack = []
 
         self.image_list = []
         self.display_image_list = []
         self.current_image_index = 0
         self.annotations = {}
         self.crops =[]
-        self.undo_stack = []
-        self.redo_stack = []
         self.box_index_counter = 1
         self.categories = []
         self.names = []
         self.last_drawn_rect = None
         self.annotation_labels = []
+        self.annotation_store = None  # AnnotationStore for the open project
+        self.pyramid_cache = OrderedDict()  # image path -> ImagePyramid, most recent last
+        self.pyramid_cache_size = 3
         self.image_counter_label = ttk.Label()
         self.category_stage_map = {
             'healthy': set(['Healthy']),
@@ -145,72 +753,19 @@ class AnnotationTool:
         
         
         
-    def save_annotations_to_json(self):
-        project_folder_path = os.path.join(os.path.dirname(self.source_folder), "annotations.json")
-
-        # Load existing annotations if available
-        if os.path.exists(project_folder_path):
-            with open(project_folder_path, 'r') as f:
-                try:
-                    json_data = json.load(f)
-                except json.JSONDecodeError:
-                    json_data = {}
-        else:
-            json_data = {}
-
-        # Get the next available image index by checking existing keys
-        existing_indices = [int(k) for k in json_data.keys()]
-        image_index = max(existing_indices) + 1 if existing_indices else 1
-        box_index = 1  # Global box index
+    def save_annotations_to_json(self, filename=None, compact=False):
+        """Write one image's current boxes to annotations.json; compact=True also folds the patch log."""
+        if self.annotation_store is None:
+            return
+        if filename is not None:
+            self.annotation_store.upsert(self.record_path(filename), self.annotations.get(filename))
+        if compact:
+            self.annotation_store.compact()
 
+    def record_path(self, filename):
+        """Key of an image's record in annotations.json"""
         final_folder_name = os.path.basename(self.source_folder)
-
-        for filename in sorted(self.annotations.keys()):
-            # Build custom image path
-            rel_path = os.path.join("Project_Folder", final_folder_name, filename).replace("\\", "/")
-            image_entry = {
-                "path": rel_path,
-                "bounding_and_label": []
-            }
-
-            for ann in self.annotations[filename]:
-                x0, y0, x1, y1, crop, category, name, stage = ann
-                image_entry["bounding_and_label"].append({
-                    "index": box_index,
-                    "x0": x0,
-                    "y0": y0,
-                    "x1": x1,
-                    "y1": y1,
-                    "crop": crop,
-                    "category": category,
-                    "name": name,
-                    "stage": stage
-                })
-                box_index += 1
-
-            json_data[str(image_index)] = image_entry
-            image_index += 1
-
-        # Save the merged annotations
-        with open(project_folder_path, 'w') as f:
-            json.dump(json_data, f, indent=4)
-
-            
-    def load_stack_file(self, filename):
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                try:
-                    return json.load(f)
-                except json.JSONDecodeError:
-                    return {}
-        return {}
-
-
-
-    def save_stack_file(self, filename, stack_dict):
-        with open(filename, 'w') as f:
-            json.dump(stack_dict, f, indent=4)
-
+        return os.path.join("Project_Folder", final_folder_name, filename).replace("\\", "/")
 
     def load_annotations_from_json(self):
         self.annotations = {}  # Reset current annotations
@@ -220,33 +775,24 @@ class AnnotationTool:
 
         parent_dir = os.path.dirname(self.source_folder)
         json_path = os.path.join(parent_dir, "annotations.json")
-
-        if not os.path.exists(json_path):
-            return  # Nothing to load
+        self.annotation_store = AnnotationStore(json_path)
+        self.annotations = LazyAnnotations(self.annotation_store)
 
         try:
-            if os.path.getsize(json_path) == 0:
-                print("Empty annotations.json file. Skipping load.")
-                return
-
-            with open(json_path, 'r') as f:
-                json_data = json.load(f)
-            
-            # Compare final folder name to ensure it's for the correct project
+            # Only records under Project_Folder/<final folder>/ are touched; boxes load on first display
             final_folder_name = os.path.basename(self.source_folder)
-
-            for entry in json_data.values():
-                image_path = entry["path"]
-                parts = image_path.split("/")  # Expecting format: Project_Folder/final_folder/filename
-                if len(parts) >= 3 and parts[0] == "Project_Folder" and parts[1] == final_folder_name:
-                    filename = parts[2]
-                    if filename in self.image_list:
-                        self.annotations.setdefault(filename, [])
-                        for bbox in entry["bounding_and_label"]:
-                            self.annotations[filename].append((
-                                bbox["x0"], bbox["y0"], bbox["x1"], bbox["y1"],
-                                bbox["crop"], bbox["category"], bbox["name"], bbox["stage"]
-                            ))
+            prefix = f"Project_Folder/{final_folder_name}/"
+            loaded, on_disk = self.annotation_store.load_folder(prefix)
+            image_set = set(self.image_list)
+
+            for image_path, labels in on_disk.items():
+                filename = image_path[len(prefix):]
+                if filename in image_set:
+                    self.annotations.unloaded[filename] = (image_path, labels)
+            for image_path, boxes in loaded.items():
+                filename = image_path[len(prefix):]
+                if filename in image_set:
+                    self.annotations[filename] = AnnotationStore.to_annotations(boxes)
         except Exception as e:
             print(f"Error loading annotations: {e}")
     def zoom_in(self):
@@ -264,13 +810,8 @@ class AnnotationTool:
         )
         self.folder_key = os.path.basename(self.source_folder)
 
-        # Load global stacks from JSON
-        self.undo_dict = self.load_stack_file(self.undo_file)
-        self.redo_dict = self.load_stack_file(self.redo_file)
-
-        # Load current folder's stack
-        self.undo_stack = self.undo_dict.get(self.folder_key, [])
-        self.redo_stack = self.redo_dict.get(self.folder_key, [])
+        # Load current folder's history shard
+        self.history = HistoryShard(self.history_dir, self.folder_key, (self.undo_file, self.redo_file))
         self.image_counter_label.pack(side="top", anchor="ne", pady=5) 
         back_btn = ttk.Button(self.root, text="🔙 Back", command=self.back_to_page1)
         back_btn.pack(anchor='nw', padx=10, pady=10)
@@ -295,8 +836,9 @@ class AnnotationTool:
                                 xscrollcommand=self.h_scrollbar.set,
                                 yscrollcommand=self.v_scrollbar.set)
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.h_scrollbar.config(command=self.canvas.xview)
-        self.v_scrollbar.config(command=self.canvas.yview)
+        self.h_scrollbar.config(command=self.on_xscroll)
+        self.v_scrollbar.config(command=self.on_yscroll)
+        self.canvas.bind("<Configure>", lambda e: self.render_visible_tiles())
         self.canvas.bind("<ButtonPress-1>", self.on_press)
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_release)
@@ -305,6 +847,9 @@ class AnnotationTool:
         self.rect_start = None
         self.current_rect = None
         self.zoom_level = 1.0
+        self.view = ViewTransform(self.zoom_level)
+        self.pyramid = None
+        self.tile_items = {}  # (col, row) -> (canvas item id, PhotoImage)
         nav_frame = tk.Frame(self.root, bg="#d9ecff")
         nav_frame.pack(fill=tk.X, side=tk.BOTTOM, pady=10)
 
@@ -348,7 +893,7 @@ class AnnotationTool:
         self.display_image()
                 
     def back_to_page1(self):
-        self.save_annotations_to_json()  # Save annotations before leaving
+        self.save_annotations_to_json(compact=True)  # Save annotations before leaving
         # Save current image index to session file
         folder_key = os.path.basename(self.selected_source_folder)
         session_path = os.path.join(".session", "session.json")
@@ -381,22 +926,22 @@ class AnnotationTool:
     
     
     def delete_annotation(self, event):
-        x_click, y_click = event.x, event.y
+        # Boxes are in source pixels; bring the click there instead of mapping every box to the canvas
+        x_click, y_click = self.view.to_stored([self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)] * 2)[0][:2]
         filename = self.display_image_list[self.current_image_index]
-        if filename in self.annotations:
-            updated_annots = []
-            deleted = False
-            for annot in self.annotations[filename]:
-                x0, y0, x1, y1, crop, category, name, stage = annot
-                
-                if x0 <= x_click <= x1 and y0 <= y_click <= y1 and not deleted:
-                    deleted = True
-                    continue  # skip this one
-                updated_annots.append(annot)
-            if deleted:
-                self.annotations[filename] = updated_annots
+        if filename in self.annotations and self.annotations[filename]:
+            box_ids = list(self.annotations[filename])
+            boxes = np.array([self.annotations[filename][box_id][:4] for box_id in box_ids], dtype=float)
+            left, right = np.minimum(boxes[:, 0], boxes[:, 2]), np.maximum(boxes[:, 0], boxes[:, 2])
+            top, bottom = np.minimum(boxes[:, 1], boxes[:, 3]), np.maximum(boxes[:, 1], boxes[:, 3])
+            hits = np.flatnonzero((left <= x_click) & (x_click <= right) & (top <= y_click) & (y_click <= bottom))
+            if hits.size:
+                # Smallest box under the click, so a box nested inside another can still be picked
+                areas = (right - left)[hits] * (bottom - top)[hits]
+                box_id = box_ids[hits[np.argmin(areas)]]
+                del self.annotations[filename][box_id]
                 self.display_image()
-                self.save_annotations_to_json()
+                self.save_annotations_to_json(filename)
                 
     def clear_current_annotations(self):
         if not self.display_image_list:
@@ -404,17 +949,16 @@ class AnnotationTool:
         filename = self.display_image_list[self.current_image_index]
                 # Remove annotations from memory
         if filename in self.annotations:
-            cleared_annotations = self.annotations[filename]
+            cleared_boxes = [[box_id, ann] for box_id, ann in self.annotations[filename].items()]
             source_image_path = os.path.join(self.source_folder, filename)
-            box_index = len(self.annotations[filename]) - 1 
-            self.redo_stack.append({
-                "filename": filename,
-                "annotations": cleared_annotations,
-                "source_image_path": source_image_path,
-                "box_index": box_index# Save entire list
-            })
+            if cleared_boxes and self.history is not None:
+                self.history.push("redo", {
+                    "filename": filename,
+                    "boxes": cleared_boxes,
+                    "source_image_path": source_image_path
+                })
             del self.annotations[filename]
-        self.save_annotations_to_json()
+        self.save_annotations_to_json(filename)
         self.display_image()
         
     def clear_root(self):
@@ -441,16 +985,6 @@ class AnnotationTool:
             return
         self.source_folder = self.selected_source_folder
         self.folder_key = os.path.basename(self.source_folder)
-
-        # Load undo/redo stacks from JSON file
-        self.undo_dict = self.load_stack_file(self.undo_file)
-        self.redo_dict = self.load_stack_file(self.redo_file)
-
-        # Get stacks for current folder
-        self.undo_stack = self.undo_dict.get(self.folder_key, [])
-        self.redo_stack = self.redo_dict.get(self.folder_key, [])
-
-        
         self.setup_page2()
 
     def display_image(self):
@@ -464,40 +998,85 @@ class AnnotationTool:
             return
 
         image_path = os.path.join(self.source_folder, self.display_image_list[self.current_image_index])
-        self.current_image = Image.open(image_path)
-
-        img_width, img_height = self.current_image.size
-        zoomed_width = int(img_width * self.zoom_level)
-        zoomed_height = int(img_height * self.zoom_level)
-        resized_image = self.current_image.resize((zoomed_width, zoomed_height), Image.LANCZOS)
+        self.pyramid = self.get_pyramid(image_path)
+        self.current_image = self.pyramid.levels[0]
 
-        self.tk_image = ImageTk.PhotoImage(resized_image)
-        self.canvas.create_image(0, 0, anchor="nw", image=self.tk_image)
+        zoomed_width, zoomed_height = self.pyramid.zoomed_size(self.zoom_level)
+        self.zoomed_size = (zoomed_width, zoomed_height)
+        self.tile_items = {}
         self.canvas.config(scrollregion=(0, 0, zoomed_width, zoomed_height))
+        self.render_visible_tiles()
 
         self.file_name_label.config(text=self.display_image_list[self.current_image_index])
 
         filename = self.display_image_list[self.current_image_index]
-        if filename in self.annotations:
-            for ann in self.annotations[filename]:
-                x0, y0, x1, y1, crop, category, name, stage = ann
-                zx0, zy0, zx1, zy1 = [coord * self.zoom_level for coord in (x0, y0, x1, y1)]
+        if self.view.scale != self.zoom_level:
+            self.view = ViewTransform(self.zoom_level)
+        anns = list(self.annotations[filename].values()) if filename in self.annotations else []
+        if anns:
+            view_boxes = self.view.to_view([ann[:4] for ann in anns]).tolist()
+            for ann, (zx0, zy0, zx1, zy1) in zip(anns, view_boxes):
+                crop, category, name, stage = ann[4:8]
                 label_str = f"{crop} | {category} | {name} | {stage}"
                 rect_id = self.canvas.create_rectangle(zx0, zy0, zx1, zy1, outline='red', width=2)
                 text_id = self.canvas.create_text(zx0 + 5, zy0 - 15, anchor="nw", fill="red", text=label_str, font=('Arial', 10, 'bold'))
                 self.annotation_labels.extend([rect_id, text_id])
 
         self.update_stats()
+
+    def get_pyramid(self, image_path):
+        pyramid = self.pyramid_cache.get(image_path)
+        if pyramid is None:
+            pyramid = ImagePyramid(image_path)
+            self.pyramid_cache[image_path] = pyramid
+            while len(self.pyramid_cache) > self.pyramid_cache_size:
+                self.pyramid_cache.popitem(last=False)
+        self.pyramid_cache.move_to_end(image_path)
+        return pyramid
+
+    def render_visible_tiles(self):
+        """Materialise only the tiles that intersect the visible part of the scrollregion."""
+        if self.pyramid is None:
+            return
+        tile = ImagePyramid.TILE_SIZE
+        zoomed_width, zoomed_height = self.zoomed_size
+        left = max(0, int(self.canvas.canvasx(0)))
+        top = max(0, int(self.canvas.canvasy(0)))
+        right = min(zoomed_width, int(self.canvas.canvasx(max(self.canvas.winfo_width(), 1))) + 1)
+        bottom = min(zoomed_height, int(self.canvas.canvasy(max(self.canvas.winfo_height(), 1))) + 1)
+        if right <= left or bottom <= top:
+            return
+
+        visible = {(col, row)
+                   for col in range(left // tile, (right - 1) // tile + 1)
+                   for row in range(top // tile, (bottom - 1) // tile + 1)}
+
+        for key in [key for key in self.tile_items if key not in visible]:
+            item_id, _ = self.tile_items.pop(key)
+            self.canvas.delete(item_id)
+
+        for col, row in visible:
+            if (col, row) in self.tile_items:
+                continue
+            photo = ImageTk.PhotoImage(self.pyramid.render_tile(self.zoom_level, col, row))
+            item_id = self.canvas.create_image(col * tile, row * tile, anchor="nw", image=photo, tags=("tile",))
+            self.tile_items[(col, row)] = (item_id, photo)
+        self.canvas.tag_lower("tile")
+
+    def on_xscroll(self, *args):
+        self.canvas.xview(*args)
+        self.render_visible_tiles()
+
+    def on_yscroll(self, *args):
+        self.canvas.yview(*args)
+        self.render_visible_tiles()
+
     def update_stats(self): 
         total_images = len(self.image_list)
         completed = self.current_image_index + 1  # Number of images already viewed (1-based)
         remaining = total_images - completed
 
-        label_count = {}
-        for anns in self.annotations.values():
-            for ann in anns:
-                label = f"{ann[4]}:{ann[5]}"
-                label_count[label] = label_count.get(label, 0) + 1
+        label_count = self.annotations.label_counts()
 
         # Count bounding boxes in current image
         current_filename = self.display_image_list[self.current_image_index]
@@ -522,10 +1101,12 @@ class AnnotationTool:
         img_width = int(self.current_image.width * self.zoom_level)
         img_height = int(self.current_image.height * self.zoom_level)
         
-        if 0 <= event.x <= img_width and 0 <= event.y <= img_height:
+        # Canvas coordinates, so a scrolled view still lines up with the image
+        x, y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        if 0 <= x <= img_width and 0 <= y <= img_height:
             self.unsaved_changes = True
-            self.rect_start_canvas = (event.x, event.y)
-            self.current_rect = self.canvas.create_rectangle(event.x, event.y, event.x, event.y, outline='red')
+            self.rect_start_canvas = (x, y)
+            self.current_rect = self.canvas.create_rectangle(x, y, x, y, outline='red')
             self.last_drawn_rect = self.current_rect
         else:
             self.rect_start_canvas = None
@@ -535,22 +1116,19 @@ class AnnotationTool:
     def on_drag(self, event):
         if self.current_rect and self.rect_start_canvas:
             x0, y0 = self.rect_start_canvas
-            x1 = min(max(event.x, 0), self.tk_image.width())   # clip to canvas width
-            y1 = min(max(event.y, 0), self.tk_image.height())  # clip to canvas height
+            x1 = min(max(self.canvas.canvasx(event.x), 0), self.zoomed_size[0])   # clip to canvas width
+            y1 = min(max(self.canvas.canvasy(event.y), 0), self.zoomed_size[1])  # clip to canvas height
             self.canvas.coords(self.current_rect, x0, y0, x1, y1)
 
     def on_release(self, event):
         if self.rect_start_canvas:
             x0_canvas, y0_canvas = self.rect_start_canvas
             # Clip end coordinates to canvas/image bounds
-            x1_canvas = min(max(event.x, 0), self.tk_image.width())
-            y1_canvas = min(max(event.y, 0), self.tk_image.height())
+            x1_canvas = min(max(self.canvas.canvasx(event.x), 0), self.zoomed_size[0])
+            y1_canvas = min(max(self.canvas.canvasy(event.y), 0), self.zoomed_size[1])
 
             # Convert back to image coordinates (not canvas)
-            x0_img = x0_canvas / self.zoom_level
-            y0_img = y0_canvas / self.zoom_level
-            x1_img = x1_canvas / self.zoom_level
-            y1_img = y1_canvas / self.zoom_level
+            x0_img, y0_img, x1_img, y1_img = self.view.to_stored([x0_canvas, y0_canvas, x1_canvas, y1_canvas])[0].tolist()
 
             # Enforce minimum size in image scale
             if abs(x1_img - x0_img) > 10 / self.zoom_level and abs(y1_img - y0_img) > 10 / self.zoom_level:
@@ -677,20 +1255,20 @@ class AnnotationTool:
                 filename = self.display_image_list[self.current_image_index]
                 source_image_path = os.path.join(self.source_folder_path, filename)
                 if filename not in self.annotations:
-                    self.annotations[filename] = []
-                self.annotations[filename].append((x0, y0, x1, y1, crop, category, name, stage))
+                    self.annotations[filename] = {}
+                box_id = self.next_box_id(filename)
+                self.annotations[filename][box_id] = (x0, y0, x1, y1, crop, category, name, stage)
 
                 action = {
                     "filename": filename,
                     "annotation": (x0, y0, x1, y1, crop, category, name, stage),
                     "source_image_path": source_image_path,
-                    "box_index": len(self.annotations[filename]) - 1
+                    "box_id": box_id
                 }
-                self.undo_stack.append(action)
-                self.redo_stack.clear()
-                
+                self.history.push("undo", action)
+                self.history.clear("redo")
 
-                self.save_annotations_to_json()
+                self.save_annotations_to_json(filename)
                 popup1.destroy()
                 self.display_image()
                 return
@@ -782,28 +1360,22 @@ class AnnotationTool:
                 filename = self.display_image_list[self.current_image_index]
                 source_image_path = os.path.join(self.source_folder_path, filename)
                 if filename not in self.annotations:
-                    self.annotations[filename] = []
-                    
-                self.annotations[filename].append((x0, y0, x1, y1, crop, category, name, stage))
-                box_index = len(self.annotations[filename]) - 1 
+                    self.annotations[filename] = {}
+
+                box_id = self.next_box_id(filename)
+                self.annotations[filename][box_id] = (x0, y0, x1, y1, crop, category, name, stage)
                 action = {
                     "filename": filename,
                     "annotation": (x0, y0, x1, y1, crop, category, name, stage),
                     "source_image_path": source_image_path,
-                    "box_index": box_index
+                    "box_id": box_id
                 }
-                self.undo_stack.append(action)
-                self.redo_stack.clear()
+                self.history.push("undo", action)
+                self.history.clear("redo")
                 if rect_id:
                     self.canvas.delete(rect_id)
 
-                # Save after modification
-                self.undo_dict[self.folder_key] = self.undo_stack
-                self.redo_dict[self.folder_key] = self.redo_stack
-                self.save_stack_file(self.undo_file, self.undo_dict)
-                self.save_stack_file(self.redo_file, self.redo_dict)
-
-                self.save_annotations_to_json()
+                self.save_annotations_to_json(filename)
                 popup2.destroy()
                 self.display_image()
 
@@ -814,61 +1386,84 @@ class AnnotationTool:
 
         ttk.Button(popup1, text="Next", command=next_step).pack(pady=10)
         
+    def next_box_id(self, filename):
+        """Per-image ids only ever increase, also past deleted boxes, so an id never names two boxes."""
+        box_id = max(self.annotations.get(filename, {}), default=0) + 1
+        if self.annotation_store is not None:
+            next_ids = self.annotation_store.next_ids
+            rel_path = self.record_path(filename)
+            box_id = max(box_id, next_ids.get(rel_path, 1))
+            next_ids[rel_path] = box_id + 1
+        return box_id
+
+    def remove_action_boxes(self, action):
+        """Take the boxes an action added off its image, by box id."""
+        boxes = self.annotations.get(action["filename"])
+        if not boxes:
+            return
+        if action.get("boxes") is not None:
+            targets = action["boxes"]
+        elif action.get("annotations") is not None:
+            targets = [[None, ann] for ann in action["annotations"]]
+        else:
+            targets = [[action.get("box_id"), action["annotation"]]]
+        for box_id, ann in targets:
+            if box_id is None:
+                # Actions saved before boxes had ids
+                box_id = next((key for key, value in boxes.items() if value == ann), None)
+            boxes.pop(box_id, None)
+
+    def restore_action_boxes(self, action):
+        """Put an action's boxes back on its image and note the ids they got."""
+        filename = action["filename"]
+        if filename not in self.annotations:
+            self.annotations[filename] = {}
+        boxes = self.annotations[filename]
+        if action.get("boxes") is not None:
+            targets = action["boxes"]
+        elif action.get("annotations") is not None:
+            targets = [[None, ann] for ann in action.pop("annotations")]
+        else:
+            targets = [[action.get("box_id"), action["annotation"]]]
+        restored = []
+        for box_id, ann in targets:
+            if box_id is None or box_id in boxes:
+                box_id = self.next_box_id(filename)
+            boxes[box_id] = ann
+            restored.append([box_id, ann])
+        if "annotation" in action:
+            action["box_id"] = restored[0][0]
+        else:
+            action["boxes"] = restored
+
     def undo_action(self, event=None):
-        if not self.undo_stack:
+        if self.history is None or not self.display_image_list:
             return
 
-        # Find last undo action for current image
-        for i in reversed(range(len(self.undo_stack))):
-            if self.undo_stack[i]["filename"] == self.display_image_list[self.current_image_index]:
-                last_action = self.undo_stack.pop(i)
-                self.redo_stack.append(last_action)
+        # Latest action on the current image
+        filename = self.display_image_list[self.current_image_index]
+        last_action = self.history.pop("undo", filename)
+        if last_action is None:
+            return
+        self.remove_action_boxes(last_action)
+        self.history.push("redo", last_action)
 
-                annotation_to_remove = last_action["annotation"]
-                filename = last_action["filename"]
+        self.save_annotations_to_json(filename)
+        self.display_image()
 
-                if filename in self.annotations:
-                    try:
-                        self.annotations[filename].remove(annotation_to_remove)
-                    except ValueError:
-                        pass  # Already removed
-
-                self.save_annotations_to_json()
-                # Save after modification
-                self.undo_dict[self.folder_key] = self.undo_stack
-                self.redo_dict[self.folder_key] = self.redo_stack
-                self.save_stack_file(self.undo_file, self.undo_dict)
-                self.save_stack_file(self.redo_file, self.redo_dict)
-                self.display_image()
-                break
-    
     def redo_action(self, event=None):
-        if not self.redo_stack:
+        if self.history is None or not self.display_image_list:
             return
 
-        # Find last redo action for current image
-        for i in reversed(range(len(self.redo_stack))):
-            if self.redo_stack[i]["filename"] == self.display_image_list[self.current_image_index]:
-                action = self.redo_stack.pop(i)
-                self.undo_stack.append(action)
-
-                filename = action["filename"]
-                annotations_to_restore = action.get("annotations") or [action["annotation"]]
-
-                if filename not in self.annotations:
-                    self.annotations[filename] = []
-
-                self.annotations[filename].extend(annotations_to_restore)
-
-                self.save_annotations_to_json()
-                # Save after modification
-                self.undo_dict[self.folder_key] = self.undo_stack
-                self.redo_dict[self.folder_key] = self.redo_stack
-                self.save_stack_file(self.undo_file, self.undo_dict)
-                self.save_stack_file(self.redo_file, self.redo_dict)
-                self.display_image()
-                break
+        filename = self.display_image_list[self.current_image_index]
+        action = self.history.pop("redo", filename)
+        if action is None:
+            return
+        self.restore_action_boxes(action)
+        self.history.push("undo", action)
 
+        self.save_annotations_to_json(filename)
+        self.display_image()
 
     def on_exit(self): 
         if not self.selected_source_folder:
@@ -892,10 +1487,10 @@ class AnnotationTool:
         with open(session_path, "w") as f:
             json.dump(session_data, f, indent=2)
 
-        self.save_annotations_to_json()
+        self.save_annotations_to_json(compact=True)
 
         if messagebox.askyesno("Exit", "Do you want to save and exit the application?"):
-            self.save_annotations_to_json()
+            self.save_annotations_to_json(compact=True)
             self.root.destroy()
         else:
             return
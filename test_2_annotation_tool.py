@@ -29,6 +29,10 @@ class AnnotationTool:
         self.csv_data = []
         self.categories = []
         self.names = []
+        self.display_scale = 1.0
+        # Crop export: save only the box region (plus padding in source pixels) instead of the whole frame
+        self.crop_export = True
+        self.crop_padding = 0
         self.setup_page1()
 
     def setup_page1(self):
@@ -146,6 +150,7 @@ class AnnotationTool:
         img_width, img_height = self.current_image.size
 
         scale = min(canvas_width / img_width, canvas_height / img_height, 1.0)
+        self.display_scale = scale
         new_width = max(1, int(img_width * scale))
         new_height = max(1, int(img_height * scale))
         resized_image = self.current_image.resize((new_width, new_height), Image.LANCZOS)
@@ -161,6 +166,20 @@ class AnnotationTool:
                 label = f"{ann[4]}:{ann[5]}"
                 self.canvas.create_text(ann[0]+5, ann[1]-10, anchor="nw", fill="red", text=label)
 
+    def crop_source_region(self, x0, y0, x1, y1):
+        """Map a canvas box back to source pixels and return that region of the current image."""
+        image = self.current_image.convert("RGB")
+        if not self.crop_export:
+            return image
+        scale = self.display_scale or 1.0
+        left = max(0, int(round(min(x0, x1) / scale)) - self.crop_padding)
+        top = max(0, int(round(min(y0, y1) / scale)) - self.crop_padding)
+        right = min(image.width, int(round(max(x0, x1) / scale)) + self.crop_padding)
+        bottom = min(image.height, int(round(max(y0, y1) / scale)) + self.crop_padding)
+        if right <= left or bottom <= top:
+            return image
+        return image.crop((left, top, right, bottom))
+
     def prev_image(self):
         if self.current_image_index > 0:
             self.current_image_index -= 1
@@ -243,7 +262,7 @@ class AnnotationTool:
             save_img_path = os.path.join(img_path, img_name)
             save_txt_path = os.path.join(txt_path, txt_name)
 
-            cv2_img = cv2.cvtColor(np.array(self.current_image), cv2.COLOR_RGB2BGR)
+            cv2_img = cv2.cvtColor(np.array(self.crop_source_region(x0, y0, x1, y1)), cv2.COLOR_RGB2BGR)
             cv2.imwrite(save_img_path, cv2_img)
 
             with open(save_txt_path, 'a') as f:
@@ -4,74 +4,1536 @@ from PIL import Image, ImageTk
 import cv2
 import shutil
 import csv
+import bisect
 import os
 import numpy as np
 import json
 from tkinter import messagebox
+import hashlib
+import sqlite3
 import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+
+def project_id(source_folder, target_folder):
+    """Stable id for a source/target folder pair: a digest of the normalised paths."""
+    norm_source = os.path.normcase(os.path.abspath(source_folder))
+    norm_target = os.path.normcase(os.path.abspath(target_folder))
+    return hashlib.sha1(f"{norm_source}||{norm_target}".encode('utf-8')).hexdigest()[:16]
+
+
+def csv_rows_by_id(csv_data):
+    """{row id: row} from saved csv_data: an id-keyed dict (JSON string keys) or an older plain list."""
+    if isinstance(csv_data, dict):
+        return {int(csv_id): row for csv_id, row in csv_data.items()}
+    return dict(enumerate(row for row in csv_data if row is not None))
+
+
+class SuggestionIndex:
+    """Lowercase lookup structures for a suggestion vocabulary.
+
+    Prefix matches come from bisecting the sorted lowercase list; substring
+    matches from a trigram index, intersected and then verified (patterns
+    shorter than a trigram are a plain scan). Popups with the same vocabulary
+    share one index; an index is never changed once built.
+    """
+    GRAM = 3
+    _shared = OrderedDict()
+
+    def __init__(self, items=()):
+        self.items = sorted(set(items), key=lambda item: (item.lower(), item))
+        self.lowered = [item.lower() for item in self.items]
+        self.grams = {}  # trigram -> set of items
+        for item, text in zip(self.items, self.lowered):
+            self._index_grams(item, text)
+
+    def _index_grams(self, item, text):
+        for start in range(len(text) - self.GRAM + 1):
+            self.grams.setdefault(text[start:start + self.GRAM], set()).add(item)
+
+    @classmethod
+    def shared(cls, items):
+        wanted = frozenset(items)
+        if wanted in cls._shared:
+            cls._shared.move_to_end(wanted)
+            return cls._shared[wanted]
+        index = cls(wanted)
+        cls._shared[wanted] = index
+        if len(cls._shared) > 8:
+            cls._shared.popitem(last=False)
+        return index
+
+    def search(self, pattern, limit):
+        """Up to limit items containing pattern: prefix matches first, then by match position."""
+        pattern = pattern.lower()
+        if not pattern:
+            return self.items[:limit]
+
+        results = []
+        position = bisect.bisect_left(self.lowered, pattern)
+        while position < len(self.lowered) and self.lowered[position].startswith(pattern) and len(results) < limit:
+            results.append(self.items[position])
+            position += 1
+        if len(results) >= limit:
+            return results
+
+        if len(pattern) < self.GRAM:
+            candidates = [item for item, text in zip(self.items, self.lowered) if pattern in text]
+        else:
+            postings = sorted((self.grams.get(pattern[i:i + self.GRAM], set())
+                               for i in range(len(pattern) - self.GRAM + 1)), key=len)
+            candidates = set.intersection(*postings)
+        prefixed = set(results)
+        ranked = sorted((item.lower().find(pattern), item.lower(), item)
+                        for item in candidates if item not in prefixed)
+        for found_at, _, item in ranked:
+            if found_at < 0:
+                continue  # trigrams matched out of order
+            results.append(item)
+            if len(results) >= limit:
+                break
+        return results
+
+
 class AutoCompleteEntry(tk.Entry):
-    def __init__(self, master, suggestion_list, *args, **kwargs):
+    MAX_RESULTS = 20
+    DEBOUNCE_MS = 120
+
+    def __init__(self, master, suggestion_list, *args, scores=None, **kwargs):
         super().__init__(master, *args, **kwargs)
         self.master = master
         self.suggestion_list = sorted(suggestion_list)
+        self.index = SuggestionIndex.shared(self.suggestion_list)
+        self.scores = scores or {}  # item -> rank score; scored matches are listed first
         self.var = self["textvariable"] = tk.StringVar()
         self.var.trace_add("write", self.changed)
         self.bind("<Down>", self.move_down)
         self.bind("<Return>", self.select_item)
         self.bind("<Right>", self.select_item)
-        self.bind("<FocusOut>", lambda e: self.hide_listbox())
-        
+        self.bind("<FocusOut>", lambda e: self.after_idle(self.hide_unless_focused))
 
-        self.listbox = None
+        self.listbox = None  # created once, then refilled and re-placed
+        self.shown = []
+        self.pending_search = None
 
     def changed(self, *args):
+        # Search once typing pauses instead of on every keystroke
+        if self.pending_search is not None:
+            self.after_cancel(self.pending_search)
+        self.pending_search = self.after(self.DEBOUNCE_MS, self.update_matches)
+
+    def update_matches(self):
+        self.pending_search = None
         pattern = self.var.get().lower()
-        matches = [item for item in self.suggestion_list if pattern in item.lower()]
-        self.show_matches(matches)
+        ranked = [item for item in sorted(self.scores, key=self.scores.get, reverse=True)
+                  if pattern in item.lower()][:self.MAX_RESULTS]
+        rest = [item for item in self.index.search(pattern, self.MAX_RESULTS + len(ranked))
+                if item not in ranked]
+        self.show_matches((ranked + rest)[:self.MAX_RESULTS])
+
+    def set_text(self, value):
+        """Prefill without popping up the suggestion list; typing replaces the selection."""
+        self.var.set(value)
+        self.cancel_search()
+        self.select_range(0, tk.END)
+        self.icursor(tk.END)
 
     def show_matches(self, matches):
-        if self.listbox:
-            self.listbox.destroy()
-
         if not matches:
+            self.hide_listbox()
             return
 
-        self.listbox = tk.Listbox(self.master, height=min(5, len(matches)))
-        self.listbox.bind("<<ListboxSelect>>", self.on_listbox_select)
-
-        for match in matches:
-            self.listbox.insert(tk.END, match)
-
+        if self.listbox is None:
+            self.listbox = tk.Listbox(self.master)
+            self.listbox.bind("<<ListboxSelect>>", self.on_listbox_select)
+
+        # Only rewrite the rows after the first difference
+        common = 0
+        while common < min(len(matches), len(self.shown)) and matches[common] == self.shown[common]:
+            common += 1
+        if common < len(self.shown):
+            self.listbox.delete(common, tk.END)
+        if common < len(matches):
+            self.listbox.insert(tk.END, *matches[common:])
+        self.shown = list(matches)
+
+        self.listbox.config(height=min(5, len(matches)))
         self.listbox.place(x=self.winfo_rootx() - self.master.winfo_rootx(),
                            y=self.winfo_rooty() - self.master.winfo_rooty() + self.winfo_height(),
                            width=self.winfo_width())
 
     def hide_listbox(self):
         if self.listbox:
-            self.listbox.destroy()
-            self.listbox = None
+            self.listbox.place_forget()
+
+    def hide_unless_focused(self):
+        if self.listbox is None or self.focus_get() is not self.listbox:
+            self.hide_listbox()
 
     def on_listbox_select(self, event):
         if self.listbox:
             index = self.listbox.curselection()
             if index:
-                self.var.set(self.listbox.get(index))
-                self.hide_listbox()
+                self.pick(self.listbox.get(index))
 
     def select_item(self, event):
         if self.listbox:
             index = self.listbox.curselection()
             if index:
-                self.var.set(self.listbox.get(index))
+                self.pick(self.listbox.get(index))
+        self.hide_listbox()
+
+    def pick(self, value):
+        """Take a suggestion; the search its trace schedules is cancelled so the list stays hidden."""
+        self.var.set(value)
+        self.cancel_search()
         self.hide_listbox()
 
+    def cancel_search(self):
+        if self.pending_search is not None:
+            self.after_cancel(self.pending_search)
+            self.pending_search = None
+
     def move_down(self, event):
-        if self.listbox:
+        if self.listbox and self.shown:
             self.listbox.focus_set()
             self.listbox.selection_set(0)
 
 
+class DisplayFrameCache:
+    """Bounded LRU of decoded, display-sized frames plus a background prefetcher.
+
+    Frames are keyed by (path, mtime, canvas size, zoom) so an edited file or a
+    resized window never serves a stale frame. Decoding happens on worker
+    threads; the Tk thread only wraps the cached frame in a PhotoImage.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, prefetch_depth=3, workers=2):
+        self.max_bytes = max_bytes
+        self.prefetch_depth = prefetch_depth
+        self.frames = OrderedDict()  # key -> (frame, scale, source_size, nbytes)
+        self.pending = {}  # key -> Future
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame-prefetch")
+
+    def make_key(self, path, canvas_size, zoom=1.0):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = 0
+        return (path, mtime, tuple(canvas_size), round(zoom, 4))
+
+    def decode(self, path, canvas_size, zoom=1.0):
+        canvas_width, canvas_height = canvas_size
+        with Image.open(path) as img:
+            img_width, img_height = img.size
+            scale = min(canvas_width / img_width, canvas_height / img_height, 1.0) * zoom
+            new_width = max(1, int(img_width * scale))
+            new_height = max(1, int(img_height * scale))
+            # JPEGs are decoded straight at 1/2, 1/4 or 1/8 size (DCT scaling), never
+            # smaller than the target; other formats ignore the draft request.
+            img.draft(img.mode, (new_width, new_height))
+            frame = img.resize((new_width, new_height), Image.LANCZOS, reducing_gap=3.0)
+        return frame, scale, (img_width, img_height)
+
+    def get(self, path, canvas_size, zoom=1.0):
+        """Return (frame, scale, source_size), decoding synchronously on a miss."""
+        key = self.make_key(path, canvas_size, zoom)
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return entry[:3]
+            future = self.pending.get(key)
+
+        if future is not None:
+            # Already being prefetched: waiting is cheaper than decoding twice
+            try:
+                result = future.result()
+                with self.lock:
+                    self.hits += 1
+                return result
+            except Exception:
+                pass
+
+        with self.lock:
+            self.misses += 1
+        result = self.decode(path, canvas_size, zoom)
+        self.put(key, result)
+        return result
+
+    def put(self, key, result):
+        frame = result[0]
+        nbytes = frame.width * frame.height * len(frame.getbands())
+        with self.lock:
+            if key in self.frames:
+                self.current_bytes -= self.frames.pop(key)[3]
+            self.frames[key] = (*result, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.current_bytes -= evicted[3]
+
+    def prefetch(self, paths, canvas_size, zoom=1.0):
+        for path in paths:
+            key = self.make_key(path, canvas_size, zoom)
+            with self.lock:
+                if key in self.frames or key in self.pending:
+                    continue
+                self.pending[key] = self.executor.submit(self._prefetch_one, key, path, canvas_size, zoom)
+
+    def _prefetch_one(self, key, path, canvas_size, zoom):
+        try:
+            result = self.decode(path, canvas_size, zoom)
+            self.put(key, result)
+            return result
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.frames),
+                "bytes": self.current_bytes,
+                "pending": len(self.pending),
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ArtifactWriter:
+    """Write-behind worker for annotation artifacts.
+
+    The UI enqueues "write_crop", "append_box", "remove_box", "delete", "trash"
+    and "restore" jobs and returns immediately; a single worker thread executes
+    them in order.
+    Every job is appended to a journal first and marked done afterwards, so
+    jobs interrupted by a crash are replayed on the next start. Each process
+    writes its own journal and holds a lock file next to it; only journals
+    whose lock is free (their process is gone) are replayed. Jobs still
+    waiting in the queue are coalesced with later jobs for the same file.
+
+    Every crop has its own one-line text file, so removing a box deletes that
+    file; older text files holding several boxes are rewritten without the
+    first matching line. Box ids (the crop path) only pair a removal with an
+    append that is still queued.
+    """
+    def __init__(self, journal_path):
+        # pending_writes.jsonl -> pending_writes.<pid>.<ms>.jsonl for this process
+        stem, ext = os.path.splitext(journal_path)
+        self.journal_path = f"{stem}.{os.getpid()}.{int(time.time() * 1000)}{ext}"
+        self.queue = deque()
+        self.pending = {}  # path -> queued (not yet started) job for that path
+        self.condition = threading.Condition()
+        self.inflight = None
+        self.next_seq = 1
+        self.completed = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_error = None
+        self.closed = False
+        self._source_cache = (None, None)  # (source path, decoded RGB image)
+
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        legacy_offsets = os.path.join(os.path.dirname(journal_path), 'box_offsets.jsonl')
+        if os.path.exists(legacy_offsets):
+            # Line offset index of older versions, no longer used
+            os.remove(legacy_offsets)
+        # Take our own lock before the journal exists, so no other process mistakes it for an orphan
+        self.journal_lock = self._try_lock(self.journal_path + '.lock')
+        replay = self._adopt_journals(journal_path)
+        self.journal = open(self.journal_path, 'a')
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+        for job in replay:
+            self.submit(job)
+
+    # ---- journal -------------------------------------------------------------
+    @staticmethod
+    def _try_lock(lock_path):
+        """Open and exclusively lock lock_path without blocking; None if another process holds it."""
+        handle = open(lock_path, 'a+')
+        try:
+            if os.name == 'nt':
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+        return handle
+
+    @staticmethod
+    def _release_lock(handle, lock_path):
+        if handle is None:
+            return
+        try:
+            if os.name == 'nt':
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            handle.close()
+            os.remove(lock_path)
+        except OSError:
+            pass  # Another process has just opened it; it removes the file itself
+
+    def _adopt_journals(self, journal_path):
+        """Unfinished jobs from journals of processes that are no longer running.
+
+        journal_path is the base name: the per-process journals next to it are
+        checked, and so is the single shared journal older versions wrote.
+        """
+        directory = os.path.dirname(journal_path)
+        stem, ext = os.path.splitext(os.path.basename(journal_path))
+        replay = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if path == self.journal_path or not (name.startswith(stem + '.') and name.endswith(ext)):
+                continue
+            lock = self._try_lock(path + '.lock')
+            if lock is None:
+                continue  # Its annotator is still running
+            try:
+                replay.extend(self._read_journal(path))
+            except OSError as e:
+                print(f"Could not replay {path}: {e}")
+            finally:
+                self._release_lock(lock, path + '.lock')
+        return replay
+
+    @staticmethod
+    def _read_journal(journal_path):
+        if not os.path.exists(journal_path):
+            return []
+        jobs, done = {}, set()
+        with open(journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn final line from a crash
+                if "done" in record:
+                    done.update(record["done"])
+                elif "seq" in record:
+                    jobs[record["seq"]] = record["job"]
+        os.remove(journal_path)
+        return [jobs[seq] for seq in sorted(jobs) if seq not in done]
+
+    def _journal_write(self, record):
+        self.journal.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    # ---- producer side (Tk thread) -------------------------------------------
+    def submit(self, job):
+        """Queue a job dict with at least "kind" and "path"; returns immediately."""
+        with self.condition:
+            seq = self.next_seq
+            self.next_seq += 1
+            self._journal_write({"seq": seq, "job": job})
+            job = dict(job, seqs=[seq], queued_at=time.perf_counter())
+
+            queued = self.pending.get(job["path"])
+            if queued is not None and self._coalesce(queued, job):
+                self.condition.notify_all()
+                return
+
+            self.queue.append(job)
+            self.pending[job["path"]] = job
+            self.condition.notify_all()
+
+    def _coalesce(self, queued, job):
+        """Fold job into an already-queued job for the same path; True if absorbed."""
+        kind = job["kind"]
+        if kind == "append_box" and queued["kind"] == "append_box":
+            queued["ids"] = queued.get("ids") or [None] * len(queued["lines"])
+            queued["ids"].extend(job.get("ids") or [None] * len(job["lines"]))
+            queued["lines"].extend(job["lines"])
+        elif kind == "write_crop" and queued["kind"] == "write_crop":
+            queued.update(source=job["source"], box=job["box"])
+        elif kind == "remove_box" and queued["kind"] == "append_box" and job["line"] in queued["lines"]:
+            ids = queued.get("ids") or [None] * len(queued["lines"])
+            if job.get("box_id") in ids:
+                position = ids.index(job["box_id"])
+            else:
+                position = queued["lines"].index(job["line"])
+            del queued["lines"][position]
+            del ids[position]
+            queued["ids"] = ids
+        elif kind in ("delete", "trash") and queued["kind"] in ("write_crop", "append_box"):
+            # The file is going away anyway; skip the pending write but keep the delete
+            queued["cancelled"] = True
+            if kind == "trash" and queued["kind"] == "write_crop":
+                # Only the allocator's empty placeholder is on disk: delete it rather than trash it
+                job["discard"] = True
+            return False
+        else:
+            return False
+        queued["seqs"].extend(job["seqs"])
+        return True
+
+    def has_pending(self, path):
+        """True while a job for path is queued or running."""
+        with self.condition:
+            return path in self.pending or (self.inflight is not None and self.inflight["path"] == path)
+
+    def flush(self, timeout=None):
+        """Block until every queued job has been executed."""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.condition:
+            while self.queue or self.inflight is not None:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.worker.join(timeout)
+        if not self.worker.is_alive():
+            self.journal.close()
+            if os.path.getsize(self.journal_path) == 0:
+                os.remove(self.journal_path)
+            self._release_lock(self.journal_lock, self.journal_path + '.lock')
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queue_depth": len(self.queue) + (1 if self.inflight is not None else 0),
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_flush_latency_ms": (self.total_latency / self.completed * 1000) if self.completed else 0.0,
+                "max_flush_latency_ms": self.max_latency * 1000,
+                "last_error": self.last_error,
+            }
+
+    # ---- worker side -----------------------------------------------------------
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                job = self.queue.popleft()
+                if self.pending.get(job["path"]) is job:
+                    del self.pending[job["path"]]
+                self.inflight = job
+
+            try:
+                if not job.get("cancelled"):
+                    self._execute(job)
+            except Exception as e:
+                print(f"Background write failed for {job['path']}: {e}")
+                with self.condition:
+                    self.failed += 1
+                    self.last_error = str(e)
+
+            with self.condition:
+                latency = time.perf_counter() - job["queued_at"]
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.inflight = None
+                self._journal_write({"done": job["seqs"]})
+                if not self.queue:
+                    # Everything is on disk: start a fresh journal
+                    self.journal.seek(0)
+                    self.journal.truncate()
+                self.condition.notify_all()
+
+    def _execute(self, job):
+        kind, path = job["kind"], job["path"]
+        if kind == "write_crop":
+            image = self._load_source(job["source"])
+            if job.get("box"):
+                image = image.crop(tuple(job["box"]))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cv2.imwrite(path, cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR))
+        elif kind == "append_box":
+            if job["lines"]:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'a') as f:
+                    f.write("".join(line + "\n" for line in job["lines"]))
+        elif kind == "remove_box":
+            if os.path.exists(path):
+                self._remove_line(path, job["line"])
+        elif kind == "delete":
+            if os.path.exists(path):
+                os.remove(path)
+        elif kind == "trash":
+            # Keep the undone crop so a redo can rename it back
+            if os.path.exists(path) and job.get("discard"):
+                os.remove(path)
+            elif os.path.exists(path):
+                os.makedirs(os.path.dirname(job["trash"]), exist_ok=True)
+                shutil.move(path, job["trash"])  # The trash lives outside the dataset, maybe on another drive
+                os.utime(job["trash"])
+                self._evict_trash(os.path.dirname(job["trash"]), job["limit"])
+        elif kind == "restore":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not job.get("claimed"):
+                # Take the name back only if no other annotator has claimed it since the undo
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                except FileExistsError:
+                    raise FileExistsError(f"{path} was claimed by another annotator; the undone crop stays in {job['trash']}")
+            if os.path.exists(job["trash"]) and os.path.getsize(job["trash"]) > 0:
+                shutil.move(job["trash"], path)
+            else:
+                # Evicted (or never written, e.g. an empty placeholder): encode it again from the source
+                self._execute(dict(job, kind="write_crop"))
+
+    def _remove_line(self, path, line):
+        """Drop the first copy of a box line; a text file left without boxes is deleted."""
+        with open(path, 'r') as f:
+            # Whitespace-only lines are blanked boxes left by an older version
+            lines = [text for text in f.read().splitlines() if text.strip()]
+        if line in lines:
+            lines.remove(line)
+        if not lines:
+            os.remove(path)
+            return
+        with open(path + '.tmp', 'w') as f:
+            f.write("".join(text + "\n" for text in lines))
+        os.replace(path + '.tmp', path)
+
+    def _evict_trash(self, trash_dir, limit):
+        """Delete the least recently trashed crops until the trash fits in limit bytes."""
+        with os.scandir(trash_dir) as entries:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries if entry.is_file()]
+        total = sum(size for _, size, _ in files)
+        for _, size, trash_path in sorted(files):
+            if total <= limit:
+                break
+            os.remove(trash_path)
+            total -= size
+
+    def _load_source(self, source):
+        cached_path, cached_image = self._source_cache
+        if cached_path != source:
+            with Image.open(source) as img:
+                cached_image = img.convert("RGB")
+            self._source_cache = (source, cached_image)
+        return cached_image
+
+
+class FileNameAllocator:
+    """Hands out increasing, collision-free 0000.jpg-style names per directory.
+
+    Next numbers are kept in a small JSON index at the target root and seeded
+    by a single scan the first time a directory is used. Every name is claimed
+    with an exclusive create, so annotator processes sharing a target tree
+    never receive the same file, and numbers freed by undo are never reused.
+    """
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self.index_path = os.path.join(root_folder, '.annotation_names.json')
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.counters = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.counters = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.counters = {}
+
+    def allocate(self, directory, extension=".jpg"):
+        key = os.path.relpath(directory, self.root_folder).replace("\\", "/")
+        with self.lock:
+            number = self.counters.get(key)
+            if number is None:
+                os.makedirs(directory, exist_ok=True)
+                number = self._scan(directory)
+            while True:
+                name = f"{number:04d}{extension}"
+                try:
+                    # Reserve the name now; the write-behind queue fills the file in later
+                    fd = os.open(os.path.join(directory, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                    os.close(fd)
+                    break
+                except FileExistsError:
+                    number += 1
+                except FileNotFoundError:
+                    os.makedirs(directory, exist_ok=True)
+            self.counters[key] = number + 1
+            self.dirty = True
+            return name
+
+    def _scan(self, directory):
+        highest = -1
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                stem = os.path.splitext(entry.name)[0]
+                if stem.isdigit():
+                    highest = max(highest, int(stem))
+        return highest + 1
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            counters = dict(self.counters)
+            self.dirty = False
+        try:
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(counters, f, separators=(',', ':'))
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"Could not save name index: {e}")
+
+
+class TaxonomyIndex:
+    """Crops, names and category -> stage folders found under the target folder.
+
+    The crop/category/name/stage directory tree is cached in
+    .taxonomy_index.json along with each directory's mtime. refresh() stats
+    the cached directories and only re-lists the ones whose mtime changed;
+    add() records folders created by this session without touching disk.
+    """
+    DEPTH = 4  # crop / category / name / stage
+
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self.index_path = os.path.join(root_folder, '.taxonomy_index.json')
+        self.dirs = {}  # relative dir ("" for root) -> {"mtime": float, "children": [names]}
+        self.dirty = False
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.dirs = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.dirs = {}
+        self.refresh()
+
+    def refresh(self):
+        """Bring the cached tree up to date, re-listing only directories that changed."""
+        fresh = {}
+        stack = [("", 0)]
+        while stack:
+            rel, depth = stack.pop()
+            path = os.path.join(self.root_folder, rel) if rel else self.root_folder
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            cached = self.dirs.get(rel)
+            if cached is not None and cached["mtime"] == mtime:
+                children = cached["children"]
+            else:
+                children = []
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir() and not entry.name.startswith('.'):
+                            children.append(entry.name)
+                self.dirty = True
+            fresh[rel] = {"mtime": mtime, "children": children}
+            if depth + 1 < self.DEPTH:
+                for child in children:
+                    stack.append((f"{rel}/{child}" if rel else child, depth + 1))
+        if fresh.keys() != self.dirs.keys():
+            self.dirty = True
+        self.dirs = fresh
+        self._rebuild()
+
+    def _rebuild(self):
+        self.crops, self.names, self.categories = set(), set(), set()
+        self.category_stage_map = {}
+        for crop in self.dirs.get("", {}).get("children", []):
+            self.crops.add(crop)
+            for category in self.dirs.get(crop, {}).get("children", []):
+                self.categories.add(category.lower())
+                for name in self.dirs.get(f"{crop}/{category}", {}).get("children", []):
+                    self.names.add(name)
+                    for stage in self.dirs.get(f"{crop}/{category}/{name}", {}).get("children", []):
+                        self.category_stage_map.setdefault(category.lower(), set()).add(stage)
+
+    def add(self, crop, category, name, stage):
+        """Record a crop/category/name/stage folder created by this session."""
+        rel = ""
+        for part in (crop, category, name, stage):
+            entry = self.dirs.setdefault(rel, {"mtime": 0, "children": []})
+            if part not in entry["children"]:
+                entry["children"].append(part)
+                entry["mtime"] = 0  # Unknown until the next refresh re-lists it
+            rel = f"{rel}/{part}" if rel else part
+        self.crops.add(crop)
+        self.categories.add(category.lower())
+        self.names.add(name)
+        self.category_stage_map.setdefault(category.lower(), set()).add(stage)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.dirs, f, separators=(',', ':'))
+            os.replace(temp_path, self.index_path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Could not save taxonomy index: {e}")
+
+
+class ProjectScanIndex:
+    """Source image list, read with os.scandir and cached in the app-data directory.
+
+    The cache holds the folder's mtime; reopening a project only re-lists the
+    source folder when that changed. Which images are already annotated comes
+    from source paths (ArtifactIndex, CSV rows), never from crop names, which
+    do not identify a source image.
+    """
+    def __init__(self, source_folder, target_folder, cache_dir):
+        self.source_folder = source_folder
+        self.target_folder = target_folder
+        self.cache_path = os.path.join(cache_dir, f"scan_{project_id(source_folder, target_folder)}.json")
+        self.dirty = False
+        self.cache = {}
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    self.cache = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.cache = {}
+        if self.cache.pop("target", None) is not None:
+            self.dirty = True  # Older caches also listed every crop name in the target tree
+
+    def source_images(self):
+        """Sorted image file names in the source folder."""
+        mtime = os.stat(self.source_folder).st_mtime
+        cached = self.cache.get("source")
+        if cached is not None and cached["mtime"] == mtime:
+            return list(cached["images"])
+        with os.scandir(self.source_folder) as entries:
+            images = sorted(entry.name for entry in entries if entry.name.lower().endswith(('png', 'jpg', 'jpeg')))
+        self.cache["source"] = {"mtime": mtime, "images": images}
+        self.dirty = True
+        return list(images)
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            temp_path = self.cache_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.cache, f, separators=(',', ':'))
+            os.replace(temp_path, self.cache_path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Could not save scan cache: {e}")
+
+
+class ArtifactIndex:
+    """Reverse index from a source image to the crops and box lines written for it.
+
+    Kept in .artifact_index.json at the target root and updated on save,
+    undo and redo, so clearing an image only touches its own files. Several
+    source folders can share one target tree, so entries are keyed by the
+    normalised full source path. The crop path also identifies the image's
+    CSV rows (column 2).
+    """
+    def __init__(self, root_folder):
+        self.index_path = os.path.join(root_folder, '.artifact_index.json')
+        self.entries = {}  # source path -> [{"img": path, "txt": path, "line": "x0,y0,x1,y1"}]
+        self.dirty = False
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.entries = {}
+
+    @staticmethod
+    def key(source_path):
+        return os.path.normcase(os.path.abspath(source_path))
+
+    def adopt_legacy(self, crop_sources):
+        """Re-key entries saved under a bare file name, using {crop path: source path} (e.g. from the CSV).
+
+        Artifacts whose crop is not in crop_sources may belong to another
+        source folder and stay under the bare name, where lookups never see them.
+        """
+        for name in [name for name in self.entries if not os.path.isabs(name)]:
+            unresolved = []
+            for artifact in self.entries[name]:
+                source_path = crop_sources.get(artifact["img"])
+                if source_path and os.path.basename(source_path) == name:
+                    self.entries.setdefault(self.key(source_path), []).append(artifact)
+                    self.dirty = True
+                else:
+                    unresolved.append(artifact)
+            if unresolved:
+                self.entries[name] = unresolved
+            else:
+                del self.entries[name]
+
+    def add(self, source_path, img_path, txt_path, line):
+        self.entries.setdefault(self.key(source_path), []).append({"img": img_path, "txt": txt_path, "line": line})
+        self.dirty = True
+
+    def remove(self, source_path, img_path):
+        key = self.key(source_path)
+        artifacts = self.entries.get(key, [])
+        for i, artifact in enumerate(artifacts):
+            if artifact["img"] == img_path:
+                del artifacts[i]
+                break
+        if not artifacts:
+            self.entries.pop(key, None)
+        self.dirty = True
+
+    def pop(self, source_path):
+        """Forget and return every artifact recorded for source_path."""
+        self.dirty = True
+        return self.entries.pop(self.key(source_path), [])
+
+    def annotated_sources(self, source_folder):
+        """File names in source_folder that have artifacts."""
+        folder = self.key(source_folder)
+        return {os.path.basename(key) for key in self.entries
+                if os.path.isabs(key) and os.path.dirname(key) == folder}
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f, separators=(',', ':'))
+            os.replace(temp_path, self.index_path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Could not save artifact index: {e}")
+
+
+class ProjectJournal:
+    """Append-only change log plus periodic snapshot for one project's state.
+
+    Each user action is recorded as one JSON line of low-level changes, so a
+    save costs O(changes since the last save). Once the log grows past
+    COMPACT_AFTER records the next save writes a full snapshot instead and
+    truncates the log. Loading reads the snapshot and replays the log.
+    """
+    COMPACT_AFTER = 2000
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = snapshot_path + '.log'
+        self.pending = []
+        self.logged = 0  # records in the log since the last snapshot
+        self._thread = None
+
+    def record(self, op, changes):
+        self.pending.append({"op": op, "changes": changes})
+
+    def flush(self, get_state, compact=False):
+        """Write pending records (or a snapshot) on a background thread; False if one is running."""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        records, self.pending = self.pending, []
+        snapshot = None
+        if compact or self.logged + len(records) >= self.COMPACT_AFTER:
+            snapshot = get_state()
+            self.logged = 0
+        else:
+            self.logged += len(records)
+        if not records and snapshot is None:
+            return True
+
+        def _write():
+            if snapshot is not None:
+                try:
+                    temp_path = self.snapshot_path + '.tmp'
+                    with open(temp_path, 'w') as f:
+                        json.dump(snapshot, f, separators=(',', ':'))
+                    os.replace(temp_path, self.snapshot_path)
+                    # The snapshot already contains every logged change
+                    open(self.log_path, 'w').close()
+                    return
+                except Exception as e:
+                    print(f"Snapshot failed, keeping log: {e}")
+            try:
+                with open(self.log_path, 'a') as f:
+                    for record in records:
+                        f.write(json.dumps(record, separators=(',', ':')) + "\n")
+            except Exception as e:
+                print(f"Background save error: {e}")
+
+        self._thread = threading.Thread(target=_write, daemon=True)
+        self._thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def load(self):
+        """Return the snapshot with the log replayed on top of it."""
+        state = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                state = json.load(f)
+        state['csv_data'] = csv_rows_by_id(state.get('csv_data', {}))
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn final line from a crash
+                    self.apply(state, record["changes"])
+                    self.logged += 1
+        return state
+
+    @staticmethod
+    def apply(state, changes):
+        annotations = state.setdefault('annotations', {})
+        rows = state.setdefault('csv_data', {})
+        for change in changes:
+            kind = change[0]
+            if kind == "ann_add":
+                annotations.setdefault(change[1], []).append(change[2])
+            elif kind == "ann_remove":
+                boxes = annotations.get(change[1], [])
+                for i, box in enumerate(boxes):
+                    if list(box) == list(change[2]):
+                        del boxes[i]
+                        break
+            elif kind == "ann_clear":
+                annotations.pop(change[1], None)
+            elif kind == "csv_add":
+                if len(change) == 3:
+                    rows[change[1]] = change[2]
+                else:  # older logs: ["csv_add", row]
+                    rows[max(rows, default=-1) + 1] = change[1]
+            elif kind == "csv_remove":
+                legacy_paths = set()
+                for key in change[1]:
+                    if isinstance(key, int):
+                        rows.pop(key, None)
+                    else:  # older logs removed rows by saved image path
+                        legacy_paths.add(key)
+                if legacy_paths:
+                    for csv_id in [csv_id for csv_id, row in rows.items() if row[1] in legacy_paths]:
+                        del rows[csv_id]
+            elif kind == "undo_push":
+                state.setdefault('undo_stack', []).append(change[1])
+            elif kind == "undo_pop":
+                state.get('undo_stack', [None]).pop()
+            elif kind == "redo_push":
+                state.setdefault('redo_stack', []).append(change[1])
+            elif kind == "redo_pop":
+                state.get('redo_stack', [None]).pop()
+            elif kind == "redo_clear":
+                state['redo_stack'] = []
+            elif kind == "set":
+                state[change[1]] = change[2]
+
+
+class LazyAnnotations(dict):
+    """Annotation dict that fetches an image's boxes from a ProjectStore on first access.
+
+    Lookups stay lazy; iterating (keys, values, items, len) loads every image
+    first, so a full snapshot never sees only the images opened so far.
+    """
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.known = store.annotated_filenames()
+
+    def __missing__(self, filename):
+        if filename not in self.known:
+            raise KeyError(filename)
+        boxes = self.store.load_image_boxes(filename)
+        self[filename] = boxes
+        return boxes
+
+    def __contains__(self, filename):
+        return dict.__contains__(self, filename) or filename in self.known
+
+    def __setitem__(self, filename, boxes):
+        self.known.add(filename)
+        dict.__setitem__(self, filename, boxes)
+
+    def __delitem__(self, filename):
+        if filename not in self:
+            raise KeyError(filename)
+        self.known.discard(filename)
+        dict.pop(self, filename, None)
+
+    def get(self, filename, default=None):
+        try:
+            return self[filename]
+        except KeyError:
+            return default
+
+    def load_all(self):
+        missing = self.known - set(dict.keys(self))
+        if missing:
+            for filename, boxes in self.store.load_all_boxes().items():
+                if filename in missing:
+                    dict.__setitem__(self, filename, boxes)
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+
+class ProjectStore:
+    """Optional SQLite (WAL) project store with the same interface as ProjectJournal.
+
+    Every recorded action is applied as its own small transaction against
+    tables for images, labels, boxes, CSV rows, history actions and session
+    values. Boxes are loaded per image on demand, and label statistics and
+    CSV exports are plain SQL queries.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY, filename TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS labels (
+            id INTEGER PRIMARY KEY, crop TEXT, category TEXT, name TEXT, stage TEXT,
+            UNIQUE (crop, category, name, stage));
+        CREATE TABLE IF NOT EXISTS boxes (
+            id INTEGER PRIMARY KEY, image_id INTEGER NOT NULL REFERENCES images(id),
+            label_id INTEGER NOT NULL REFERENCES labels(id), x0 NUMERIC, y0 NUMERIC, x1 NUMERIC, y1 NUMERIC);
+        CREATE INDEX IF NOT EXISTS boxes_by_image ON boxes (image_id);
+        CREATE INDEX IF NOT EXISTS boxes_by_label ON boxes (label_id);
+        CREATE TABLE IF NOT EXISTS csv_rows (
+            id INTEGER PRIMARY KEY, source_path TEXT, img_path TEXT,
+            label_id INTEGER REFERENCES labels(id), x0 NUMERIC, y0 NUMERIC, x1 NUMERIC, y1 NUMERIC);
+        CREATE INDEX IF NOT EXISTS csv_rows_by_img ON csv_rows (img_path);
+        CREATE TABLE IF NOT EXISTS actions (
+            id INTEGER PRIMARY KEY, stack TEXT NOT NULL, payload TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS actions_by_stack ON actions (stack, id);
+        CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, db_path):
+        self.snapshot_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    # ---- ProjectJournal interface --------------------------------------------
+    def record(self, op, changes):
+        with self.conn:
+            for change in changes:
+                self._apply(change)
+
+    def flush(self, get_state, compact=False):
+        if compact:
+            # First save of a new session: persist the current state in one transaction
+            state = get_state()
+            with self.conn:
+                for table in ("boxes", "csv_rows", "actions", "sessions", "images"):
+                    self.conn.execute(f"DELETE FROM {table}")
+                for filename, boxes in state['annotations'].items():
+                    for box in boxes:
+                        self._apply(["ann_add", filename, box])
+                for csv_id, row in state['csv_data'].items():
+                    self._apply(["csv_add", csv_id, row])
+                for stack in ('undo', 'redo'):
+                    for action in state[f'{stack}_stack']:
+                        self._apply([f"{stack}_push", action])
+                for key in ('current_image_index', 'last_crop', 'last_category', 'last_name',
+                            'box_space', 'source_folder', 'target_folder'):
+                    self._apply(["set", key, state[key]])
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def load(self):
+        """Session values, CSV rows and history; boxes are left to LazyAnnotations."""
+        state = {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM sessions")}
+        state['annotations'] = LazyAnnotations(self)
+        state['csv_data'] = self.csv_rows()
+        for stack in ('undo', 'redo'):
+            state[f'{stack}_stack'] = [json.loads(payload) for (payload,) in self.conn.execute(
+                "SELECT payload FROM actions WHERE stack = ? ORDER BY id", (stack,))]
+        return state
+
+    def close(self):
+        self.conn.close()
+
+    # ---- queries --------------------------------------------------------------
+    def annotated_filenames(self):
+        return {filename for (filename,) in self.conn.execute(
+            "SELECT DISTINCT images.filename FROM boxes JOIN images ON images.id = boxes.image_id")}
+
+    def load_image_boxes(self, filename):
+        # Lists, like boxes read back from the JSON journal
+        return [list(row) for row in self.conn.execute(
+            """SELECT x0, y0, x1, y1, crop, category, name, stage FROM boxes
+               JOIN images ON images.id = boxes.image_id JOIN labels ON labels.id = boxes.label_id
+               WHERE images.filename = ? ORDER BY boxes.id""", (filename,))]
+
+    def load_all_boxes(self):
+        """{filename: boxes} for the whole project in one query"""
+        boxes = {}
+        for row in self.conn.execute(
+                """SELECT images.filename, x0, y0, x1, y1, crop, category, name, stage FROM boxes
+                   JOIN images ON images.id = boxes.image_id JOIN labels ON labels.id = boxes.label_id
+                   ORDER BY boxes.id"""):
+            boxes.setdefault(row[0], []).append(list(row[1:]))
+        return boxes
+
+    def box_label_counts(self):
+        """(filename, crop, category, box count) rows for LabelStats"""
+        return self.conn.execute(
+            """SELECT images.filename, crop, category, COUNT(*) FROM boxes
+               JOIN images ON images.id = boxes.image_id JOIN labels ON labels.id = boxes.label_id
+               GROUP BY images.filename, crop, category""").fetchall()
+
+    def export_rows(self):
+        return [list(row) for row in self.conn.execute(
+            """SELECT source_path, img_path, crop, category, name, stage, x0, y0, x1, y1 FROM csv_rows
+               JOIN labels ON labels.id = csv_rows.label_id ORDER BY csv_rows.id""")]
+
+    def csv_rows(self):
+        """{row id: row}, the in-memory form of csv_data"""
+        return {row[0]: list(row[1:]) for row in self.conn.execute(
+            """SELECT csv_rows.id, source_path, img_path, crop, category, name, stage, x0, y0, x1, y1 FROM csv_rows
+               JOIN labels ON labels.id = csv_rows.label_id ORDER BY csv_rows.id""")}
+
+    # ---- change application -----------------------------------------------------
+    def _image_id(self, filename):
+        self.conn.execute("INSERT OR IGNORE INTO images (filename) VALUES (?)", (filename,))
+        return self.conn.execute("SELECT id FROM images WHERE filename = ?", (filename,)).fetchone()[0]
+
+    def _label_id(self, crop, category, name, stage):
+        self.conn.execute("INSERT OR IGNORE INTO labels (crop, category, name, stage) VALUES (?, ?, ?, ?)",
+                          (crop, category, name, stage))
+        return self.conn.execute("SELECT id FROM labels WHERE crop = ? AND category = ? AND name = ? AND stage = ?",
+                                 (crop, category, name, stage)).fetchone()[0]
+
+    def _apply(self, change):
+        kind = change[0]
+        if kind == "ann_add":
+            x0, y0, x1, y1, crop, category, name, stage = change[2]
+            self.conn.execute("INSERT INTO boxes (image_id, label_id, x0, y0, x1, y1) VALUES (?, ?, ?, ?, ?, ?)",
+                              (self._image_id(change[1]), self._label_id(crop, category, name, stage), x0, y0, x1, y1))
+        elif kind == "ann_remove":
+            x0, y0, x1, y1, crop, category, name, stage = change[2]
+            self.conn.execute(
+                """DELETE FROM boxes WHERE id = (SELECT boxes.id FROM boxes
+                   JOIN images ON images.id = boxes.image_id JOIN labels ON labels.id = boxes.label_id
+                   WHERE images.filename = ? AND x0 = ? AND y0 = ? AND x1 = ? AND y1 = ?
+                   AND crop = ? AND category = ? AND name = ? AND stage = ? LIMIT 1)""",
+                (change[1], x0, y0, x1, y1, crop, category, name, stage))
+        elif kind == "ann_clear":
+            self.conn.execute("DELETE FROM boxes WHERE image_id = (SELECT id FROM images WHERE filename = ?)",
+                              (change[1],))
+        elif kind == "csv_add":
+            csv_id, row = change[1:]
+            source_path, img_path, crop, category, name, stage, x0, y0, x1, y1 = row
+            self.conn.execute(
+                """INSERT OR REPLACE INTO csv_rows (id, source_path, img_path, label_id, x0, y0, x1, y1)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (csv_id, source_path, img_path, self._label_id(crop, category, name, stage), x0, y0, x1, y1))
+        elif kind == "csv_remove":
+            self.conn.executemany("DELETE FROM csv_rows WHERE id = ?", [(csv_id,) for csv_id in change[1]])
+        elif kind in ("undo_push", "redo_push"):
+            self.conn.execute("INSERT INTO actions (stack, payload) VALUES (?, ?)",
+                              (kind[:4], json.dumps(change[1])))
+        elif kind in ("undo_pop", "redo_pop"):
+            self.conn.execute("DELETE FROM actions WHERE id = (SELECT MAX(id) FROM actions WHERE stack = ?)",
+                              (kind[:4],))
+        elif kind == "redo_clear":
+            self.conn.execute("DELETE FROM actions WHERE stack = 'redo'")
+        elif kind == "set":
+            self.conn.execute("INSERT OR REPLACE INTO sessions (key, value) VALUES (?, ?)",
+                              (change[1], json.dumps(change[2])))
+
+
+class LabelStats:
+    """Box counters updated on every add and remove, so the status bar never recounts.
+
+    Tracks boxes per "crop:category" label, per crop, per category and per
+    image; class balance and the boxes-per-image histogram are derived from
+    those counters.
+    """
+    def __init__(self):
+        self.labels = Counter()
+        self.crops = Counter()
+        self.categories = Counter()
+        self.per_image = Counter()
+        self.total = 0
+
+    @classmethod
+    def from_annotations(cls, annotations):
+        stats = cls()
+        for filename, anns in annotations.items():
+            for ann in anns:
+                stats.add(filename, ann)
+        return stats
+
+    @classmethod
+    def from_counts(cls, rows):
+        """Build from (filename, crop, category, box count) rows, e.g. a SQL GROUP BY."""
+        stats = cls()
+        for filename, crop, category, count in rows:
+            stats._update(filename, crop, category, count)
+        return stats
+
+    def _update(self, filename, crop, category, delta):
+        for counter, key in ((self.labels, f"{crop}:{category}"), (self.crops, crop),
+                             (self.categories, category), (self.per_image, filename)):
+            counter[key] += delta
+            if counter[key] <= 0:
+                del counter[key]
+        self.total += delta
+
+    def add(self, filename, ann):
+        self._update(filename, ann[4], ann[5], 1)
+
+    def remove(self, filename, ann):
+        self._update(filename, ann[4], ann[5], -1)
+
+    def clear_image(self, filename, anns):
+        for ann in anns:
+            self.remove(filename, ann)
+
+    def class_balance(self):
+        """Share of all boxes per label."""
+        return {label: count / self.total for label, count in self.labels.items()} if self.total else {}
+
+    def boxes_per_image_histogram(self):
+        """{boxes in an image: number of images with that many}"""
+        return Counter(self.per_image.values())
+
+
+class LabelSuggester:
+    """Ranks past labels by how often and how recently they were used.
+
+    Each context keeps {value: [uses, last use]}: crops overall, categories
+    per crop, names per (crop, category) and stages per (crop, category, name).
+    A value scores its use count plus a bonus that decays with every label
+    saved since it was last picked.
+    """
+    RECENCY_WEIGHT = 5.0
+    RECENCY_DECAY = 0.8
+
+    def __init__(self):
+        self.clock = 0
+        self.tables = {}  # context tuple -> {value: [uses, last use]}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Replay CSV rows (crop, category, name, stage at 2..5) oldest first."""
+        suggester = cls()
+        for row in rows:
+            suggester.observe(*row[2:6])
+        return suggester
+
+    @staticmethod
+    def _contexts(crop, category, name, stage):
+        return ((("crop",), crop), (("category", crop), category),
+                (("name", crop, category), name), (("stage", crop, category, name), stage))
+
+    def observe(self, crop, category, name, stage):
+        self.clock += 1
+        for context, value in self._contexts(crop, category, name, stage):
+            entry = self.tables.setdefault(context, {}).setdefault(value, [0, 0])
+            entry[0] += 1
+            entry[1] = self.clock
+
+    def forget(self, crop, category, name, stage):
+        """Take back one use, e.g. when the box is undone."""
+        for context, value in self._contexts(crop, category, name, stage):
+            table = self.tables.get(context, {})
+            if value in table:
+                table[value][0] -= 1
+                if table[value][0] <= 0:
+                    del table[value]
+
+    def scores(self, kind, *context):
+        table = self.tables.get((kind,) + context, {})
+        return {value: uses + self.RECENCY_WEIGHT * self.RECENCY_DECAY ** (self.clock - last)
+                for value, (uses, last) in table.items()}
+
+    def best(self, kind, *context):
+        scores = self.scores(kind, *context)
+        return max(scores, key=scores.get) if scores else None
+
+
+class ViewTransform:
+    """Maps stored box coordinates to canvas pixels and back: view = stored * scale.
+
+    The frame is drawn at the canvas origin, so the map is a pure scale. Boxes
+    go through as an (N, 4) array, so a redraw maps every box of an image in
+    one operation.
+    """
+    def __init__(self, scale=1.0):
+        self.scale = float(scale)
+
+    def to_view(self, boxes):
+        return np.asarray(boxes, dtype=float).reshape(-1, 4) * self.scale
+
+    def to_stored(self, boxes):
+        return np.asarray(boxes, dtype=float).reshape(-1, 4) / self.scale
+
+
+class BoxGrid:
+    """Uniform grid of buckets over canvas space for point-in-box queries.
+
+    Each box is listed in every cell it overlaps, so a lookup only tests the
+    boxes sharing the cursor's cell instead of every box on the image.
+    """
+    CELL = 64
+
+    def __init__(self):
+        self.cells = {}  # (column, row) -> set of keys
+        self.boxes = {}  # key -> (x0, y0, x1, y1, insertion order)
+        self.order = 0
+
+    def _cells(self, x0, y0, x1, y1):
+        for column in range(int(x0 // self.CELL), int(x1 // self.CELL) + 1):
+            for row in range(int(y0 // self.CELL), int(y1 // self.CELL) + 1):
+                yield column, row
+
+    def add(self, key, coords):
+        x0, y0, x1, y1 = coords
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        self.order += 1
+        self.boxes[key] = (x0, y0, x1, y1, self.order)
+        for cell in self._cells(x0, y0, x1, y1):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        x0, y0, x1, y1, _ = self.boxes.pop(key)
+        for cell in self._cells(x0, y0, x1, y1):
+            bucket = self.cells[cell]
+            bucket.discard(key)
+            if not bucket:
+                del self.cells[cell]
+
+    def at(self, x, y):
+        """Key of the smallest box containing (x, y); the newest one wins a tie."""
+        best, best_rank = None, None
+        for key in self.cells.get((int(x // self.CELL), int(y // self.CELL)), ()):
+            x0, y0, x1, y1, order = self.boxes[key]
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                rank = ((x1 - x0) * (y1 - y0), -order)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = key, rank
+        return best
+
+
+class CanvasScene:
+    """Retained-mode layer over a Tk canvas.
+
+    The background image item is created once and re-pointed at new bitmaps;
+    box rectangles and labels are keyed so that a sync only creates, moves or
+    deletes the items that actually changed. The same diff keeps a BoxGrid of
+    the drawn boxes for hit-testing and hover highlighting.
+    """
+    HIGHLIGHT = {"outline": "yellow", "width": 3}
+    NORMAL = {"outline": "red", "width": 2}
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.background_id = None
+        self.items = {}  # key -> (rect_id, text_id, coords, label)
+        self.grid = BoxGrid()
+        self.highlighted = None
+
+    def set_background(self, photo):
+        if self.background_id is None:
+            self.background_id = self.canvas.create_image(0, 0, anchor="nw", image=photo, tags=("background",))
+        else:
+            self.canvas.itemconfig(self.background_id, image=photo)
+        self.canvas.tag_lower(self.background_id)
+
+    def clear_background(self):
+        if self.background_id is not None:
+            self.canvas.delete(self.background_id)
+            self.background_id = None
+
+    def sync(self, boxes):
+        """Bring the canvas in line with boxes: {key: ((x0, y0, x1, y1), label)}."""
+        for key in [key for key in self.items if key not in boxes]:
+            rect_id, text_id, _, _ = self.items.pop(key)
+            self.canvas.delete(rect_id, text_id)
+            self.grid.remove(key)
+            if key == self.highlighted:
+                self.highlighted = None
+
+        for key, (coords, label) in boxes.items():
+            item = self.items.get(key)
+            if item is None:
+                x0, y0, x1, y1 = coords
+                rect_id = self.canvas.create_rectangle(x0, y0, x1, y1, outline='red', width=2)
+                text_id = self.canvas.create_text(x0 + 5, y0 - 15, anchor="nw", fill="red", text=label, font=('Arial', 10, 'bold'))
+                self.items[key] = (rect_id, text_id, coords, label)
+                self.grid.add(key, coords)
+                continue
+
+            rect_id, text_id, old_coords, old_label = item
+            if coords != old_coords:
+                self.canvas.coords(rect_id, *coords)
+                self.canvas.coords(text_id, coords[0] + 5, coords[1] - 15)
+                self.grid.remove(key)
+                self.grid.add(key, coords)
+            if label != old_label:
+                self.canvas.itemconfig(text_id, text=label)
+            self.items[key] = (rect_id, text_id, coords, label)
+
+    def box_at(self, x, y):
+        return self.grid.at(x, y)
+
+    def highlight(self, key):
+        """Outline one box (or none) as the hover target; untouched if it is already the one."""
+        if key == self.highlighted:
+            return
+        if self.highlighted in self.items:
+            self.canvas.itemconfig(self.items[self.highlighted][0], **self.NORMAL)
+        if key in self.items:
+            self.canvas.itemconfig(self.items[key][0], **self.HIGHLIGHT)
+            self.canvas.tag_raise(self.items[key][0])
+        self.highlighted = key
+
+
 class AnnotationTool:
     def __init__(self, root):
         self.root = root
@@ -100,87 +1562,252 @@ class AnnotationTool:
         self.display_image_list = []
         self.current_image_index = 0
         self.annotations = {}
-        self.csv_data = []
+        self.csv_data = {}  # row id -> CSV row; ids are never reused
+        self.stats = LabelStats()
+        self.suggester = LabelSuggester()
+        self.next_csv_id = 0
         self.categories = []
         self.names = []
         self.last_drawn_rect = None
-        self.annotation_labels = []
+        self.current_image_path = None
+        self.display_scale = 1.0
+        self.source_size = None
+        # Boxes are stored in source pixels; projects saved before that kept canvas pixels ("display")
+        self.box_space = 'source'
+        self.view = ViewTransform()
+        # Crop export: save only the box region (plus padding in source pixels) instead of the whole frame
+        self.crop_export = True
+        self.crop_padding = 0
+        # Undone crops wait in the app-data trash for a redo; oldest are dropped past this size
+        self.trash_limit_mb = 200
         self.image_counter_label = ttk.Label()
+        # Decoded-frame cache: memory cap and how many images ahead/behind to prefetch
+        self.frame_cache_max_mb = 256
+        self.prefetch_depth = 3
+        self.frame_cache = DisplayFrameCache(
+            max_bytes=self.frame_cache_max_mb * 1024 * 1024,
+            prefetch_depth=self.prefetch_depth
+        )
+        # Crops and text files are written behind the UI; see ArtifactWriter
+        self.writer = ArtifactWriter(os.path.join(
+            os.path.expanduser('~'), '.image_annotation_tool', 'pending_writes.jsonl'
+        ))
         
+        try:
+            self.collect_orphaned_projects()
+        except OSError as e:
+            print(f"Project cleanup failed: {e}")
+
         self.setup_page1()
         self.root.bind("<Control-z>", self.undo_callback)
         self.root.bind("<Control-y>", self.redo_callback)
         # Start auto-save timer
+        # Keep project state in an SQLite database instead of the JSON journal
+        self.use_sqlite_store = False
         self.auto_save_interval = 1000 # 5 minutes in milliseconds
         self.unsaved_changes = False  # New "dirty flag"
         self.root.after(self.auto_save_interval, self.auto_save)
         self.root.protocol("WM_DELETE_WINDOW", self.on_exit)  
     
-    def get_storage_path(self):
+    def get_storage_path(self, source_folder=None, target_folder=None):
         """Generates unique storage path based on normalized folder paths"""
         app_data_dir = os.path.join(os.path.expanduser('~'), '.image_annotation_tool')
         os.makedirs(app_data_dir, exist_ok=True)
+        source_folder = source_folder or self.source_folder
+        target_folder = target_folder or self.target_folder
         
-        if not (self.source_folder and self.target_folder):
+        if not (source_folder and target_folder):
             return os.path.join(app_data_dir, 'unsaved_annotations.json')
         
-        # Normalize paths for consistent hashing across OS
-        norm_source = os.path.normcase(os.path.abspath(self.source_folder))
-        norm_target = os.path.normcase(os.path.abspath(self.target_folder))
-        unique_id = abs(hash(f"{norm_source}||{norm_target}"))
-        return os.path.join(app_data_dir, f'annos_{unique_id}.json')
-    def save_to_local_storage(self):
-        
-        """Save current state to local storage using a background thread"""
-        def _save():
-            data = {
-                'annotations': self.annotations.copy(),  # Create thread-safe copies
-                'csv_data': self.csv_data.copy(),
-                'current_image_index': self.current_image_index,
-                'last_crop': self.last_crop,
-                'last_category': self.last_category,
-                'last_name': self.last_name,
-                'source_folder': self.source_folder,
-                'target_folder': self.target_folder,
-                'image_list': self.image_list.copy(),
-                'display_image_list': self.display_image_list.copy(),
-                'undo_stack': [item.copy() for item in self.undo_stack],
-                'redo_stack': [item.copy() for item in self.redo_stack]
-            }
-            
+        # Same id on every run (built-in hash() is salted per process)
+        return os.path.join(app_data_dir, f'annos_{project_id(source_folder, target_folder)}.json')
+
+    def find_saved_project(self, source_folder, target_folder):
+        """Storage path of an existing project (JSON journal or SQLite) for these folders, else None."""
+        json_path = self.get_storage_path(source_folder, target_folder)
+        for path in (json_path, os.path.splitext(json_path)[0] + '.sqlite'):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def load_project_manifest(self):
+        """{storage filename: {"source": ..., "target": ..., "updated": ...}} for every saved project"""
+        manifest_path = os.path.join(os.path.expanduser('~'), '.image_annotation_tool', 'projects.json')
+        if os.path.exists(manifest_path):
             try:
-                # Atomic write operation
-                temp_path = self.get_storage_path() + '.tmp'
-                with open(temp_path, 'w') as f:
-                    json.dump(data, f, separators=(',', ':'), indent=None)
-                
-                # Replace old file only after successful write
-                os.replace(temp_path, self.get_storage_path())
-            except Exception as e:
-                print(f"Background save error: {e}")
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
-
-        # Only start a new thread if no existing save is running
-        if not hasattr(self, '_save_thread') or not self._save_thread.is_alive():
-            self._save_thread = threading.Thread(target=_save, daemon=True)
-            self._save_thread.start()
-    def list_saved_projects(self):
-        """Returns dict of {project_id: (source_path, target_path)}"""
+                with open(manifest_path, 'r') as f:
+                    return json.load(f)
+            except (OSError, json.JSONDecodeError):
+                pass
+        return {}
+
+    def save_project_manifest(self, manifest):
+        manifest_path = os.path.join(os.path.expanduser('~'), '.image_annotation_tool', 'projects.json')
+        try:
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifest_path + '.tmp', manifest_path)
+        except OSError as e:
+            print(f"Could not save project manifest: {e}")
+
+    def register_project(self, storage_path):
+        manifest = self.load_project_manifest()
+        manifest[os.path.basename(storage_path)] = {
+            "source": self.source_folder,
+            "target": self.target_folder,
+            "updated": datetime.now().isoformat(timespec='seconds')
+        }
+        self.save_project_manifest(manifest)
+
+    def read_project_folders(self, storage_path):
+        """(source, target) stored inside a project file; only used for files missing from the manifest."""
+        if storage_path.endswith('.sqlite'):
+            conn = sqlite3.connect(storage_path)
+            try:
+                values = dict(conn.execute(
+                    "SELECT key, value FROM sessions WHERE key IN ('source_folder', 'target_folder')"))
+            finally:
+                conn.close()
+            return tuple(json.loads(values.get(key, 'null')) for key in ('source_folder', 'target_folder'))
+        with open(storage_path, 'r') as f:
+            data = json.load(f)
+        return data.get('source_folder'), data.get('target_folder')
+
+    def collect_orphaned_projects(self):
+        """Fold files named by the old salted hash() into stable ids and drop stale entries and caches."""
         app_data_dir = os.path.join(os.path.expanduser('~'), '.image_annotation_tool')
-        projects = {}
-        
+        if not os.path.isdir(app_data_dir):
+            return
+        manifest = self.load_project_manifest()
+        changed = False
+
+        def project_files(path):
+            return [path + suffix for suffix in ('', '.log', '.tmp', '-wal', '-shm') if os.path.exists(path + suffix)]
+
         for fname in os.listdir(app_data_dir):
-            if fname.startswith('annos_') and fname.endswith('.json'):
-                try:
-                    with open(os.path.join(app_data_dir, fname), 'r') as f:
-                        data = json.load(f)
-                    projects[fname] = (data.get('source_folder'), data.get('target_folder'))
-                except:
+            if not fname.startswith('annos_') or not fname.endswith(('.json', '.sqlite')) or fname in manifest:
+                continue
+            path = os.path.join(app_data_dir, fname)
+            try:
+                source, target = self.read_project_folders(path)
+            except Exception:
+                continue
+            if not source or not target:
+                continue
+
+            stable_name = f"annos_{project_id(source, target)}{os.path.splitext(fname)[1]}"
+            stable_path = os.path.join(app_data_dir, stable_name)
+            if stable_name != fname:
+                if os.path.exists(stable_path) and os.path.getmtime(stable_path) >= os.path.getmtime(path):
+                    # An equal or newer copy already exists under the stable id
+                    for old_file in project_files(path):
+                        os.remove(old_file)
                     continue
-        return projects
+                for old_file in project_files(stable_path):
+                    os.remove(old_file)
+                for old_file in project_files(path):
+                    os.replace(old_file, stable_path + old_file[len(path):])
+            manifest[stable_name] = {
+                "source": source,
+                "target": target,
+                "updated": datetime.fromtimestamp(os.path.getmtime(stable_path)).isoformat(timespec='seconds')
+            }
+            changed = True
+
+        for fname in list(manifest):
+            if not os.path.exists(os.path.join(app_data_dir, fname)):
+                del manifest[fname]
+                changed = True
+
+        live_ids = {os.path.splitext(fname)[0][len('annos_'):] for fname in manifest}
+        for fname in os.listdir(app_data_dir):
+            if fname.startswith('scan_') and fname.endswith('.json') and fname[len('scan_'):-len('.json')] not in live_ids:
+                os.remove(os.path.join(app_data_dir, fname))
+
+        if changed:
+            self.save_project_manifest(manifest)
+    def open_project_store(self, storage_path):
+        """ProjectStore for .sqlite project files, ProjectJournal otherwise."""
+        if storage_path.endswith('.sqlite'):
+            return ProjectStore(storage_path)
+        return ProjectJournal(storage_path)
+
+    def trash_path(self, action):
+        """Trash location of an action's crop, named after the source image and box it was cut from."""
+        source_box = action.get("source_box") or self.source_box(*action["annotation"][:4])
+        if source_box is None:
+            # Full-frame export (crop_export off, or a zero-area box): key on the stored box instead
+            source_box = ["full"] + list(action["annotation"][:4])
+        key = f"{os.path.join(self.source_folder, action['filename'])}|{list(source_box)}"
+        # Outside the target tree, so folder-per-class loaders never see it
+        return os.path.join(os.path.expanduser('~'), '.image_annotation_tool', 'trash',
+                            project_id(self.source_folder, self.target_folder),
+                            hashlib.sha1(key.encode('utf-8')).hexdigest() + ".jpg")
+
+    def reclaim_crop_name(self, action):
+        """Claim an undone crop's file name again for a redo; True if the restore may write into it.
+
+        Undo frees the name, so another annotator sharing the target tree may
+        have taken it since. Then the action moves to a newly allocated name.
+        While the undo's own trash job is still queued the file is still ours,
+        and the restore job claims the name itself once the trash has run.
+        """
+        img_path = action["img_path"]
+        if self.writer.has_pending(img_path):
+            return False
+        try:
+            os.makedirs(os.path.dirname(img_path), exist_ok=True)
+            os.close(os.open(img_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            img_name = self.name_allocator.allocate(os.path.dirname(img_path))
+            action["img_path"] = os.path.join(os.path.dirname(img_path), img_name)
+            action["txt_path"] = os.path.join(os.path.dirname(action["txt_path"]), img_name.replace('.jpg', '.txt'))
+        return True
+
+    def add_csv_row(self, row, csv_id=None):
+        """Store a CSV row under a new id (or the given one, for redo) and return the id."""
+        if csv_id is None:
+            csv_id = self.next_csv_id
+        self.next_csv_id = max(self.next_csv_id, csv_id + 1)
+        self.csv_data[csv_id] = row
+        return csv_id
+
+    def project_state(self):
+        """Full snapshot of the project, detached from the live structures."""
+        return {
+            'annotations': {k: list(v) for k, v in self.annotations.items()},
+            'csv_data': dict(self.csv_data),
+            'current_image_index': self.current_image_index,
+            'last_crop': self.last_crop,
+            'last_category': self.last_category,
+            'last_name': self.last_name,
+            'box_space': self.box_space,
+            'source_folder': self.source_folder,
+            'target_folder': self.target_folder,
+            'image_list': self.image_list.copy(),
+            'display_image_list': self.display_image_list.copy(),
+            'undo_stack': [item.copy() for item in self.undo_stack],
+            'redo_stack': [item.copy() for item in self.redo_stack]
+        }
+
+    def record_change(self, op, changes):
+        """Log one user action for the next save; changes use ProjectJournal.apply's format."""
+        if getattr(self, 'journal', None) is not None:
+            self.journal.record(op, changes)
+        self.unsaved_changes = True
+
+    def save_to_local_storage(self, compact=False):
+        """Append the changes since the last save to the project journal (in the background)"""
+        if getattr(self, 'journal', None) is None:
+            return True
+        return self.journal.flush(self.project_state, compact=compact)
+
+    def list_saved_projects(self):
+        """Returns dict of {project_id: (source_path, target_path)}"""
+        return {
+            fname: (entry.get('source'), entry.get('target'))
+            for fname, entry in self.load_project_manifest().items()
+        }
 
     def load_specific_project(self, project_id):
         """Load a specific project by its storage filename"""
@@ -233,6 +1860,11 @@ class AnnotationTool:
 
         ttk.Button(frame, text="✅ Done", command=self.on_done).pack(pady=30)
         
+    def get_scan_index(self):
+        app_data_dir = os.path.join(os.path.expanduser('~'), '.image_annotation_tool')
+        os.makedirs(app_data_dir, exist_ok=True)
+        return ProjectScanIndex(self.source_folder, self.target_folder, app_data_dir)
+
     def filter_annotated_images(self):
         """
         Filters and organizes images based on annotation status.
@@ -268,14 +1900,28 @@ class AnnotationTool:
         # Preserve paths in case user returns
         self.selected_source_folder = self.source_folder
         self.selected_target_folder = self.target_folder
-        self.image_list = sorted([f for f in os.listdir(self.source_folder) if f.lower().endswith(('png', 'jpg', 'jpeg'))])
-
-        annotated_images = set()
-        for category in self.categories:
-            for name in self.names:
-                img_dir = os.path.join(self.target_folder, category, name, 'images')
-                if os.path.exists(img_dir):
-                    annotated_images.update(os.listdir(img_dir))
+        scan_index = self.get_scan_index()
+        self.image_list = scan_index.source_images()
+        self.artifacts = ArtifactIndex(self.target_folder)
+        self.artifacts.adopt_legacy({row[1]: row[0] for row in self.csv_data.values()})
+        # An older version kept a line-offset index in each text_files folder; it is not a label file
+        for txt_dir in {os.path.dirname(artifact["txt"]) for artifacts in self.artifacts.entries.values()
+                        for artifact in artifacts}:
+            for leftover in ('.box_offsets.jsonl', '.box_offsets.jsonl.tmp'):
+                if os.path.exists(os.path.join(txt_dir, leftover)):
+                    os.remove(os.path.join(txt_dir, leftover))
+        if isinstance(getattr(self, 'journal', None), ProjectStore):
+            self.stats = LabelStats.from_counts(self.journal.box_label_counts())
+        else:
+            self.stats = LabelStats.from_annotations(self.annotations)
+        # csv_data is kept in save order, so replaying it gives both counts and recency
+        self.suggester = LabelSuggester.from_rows(self.csv_data.values())
+        # Crops are renamed on save, so only source paths (reverse index, CSV rows) link them back to their source
+        source_key = ArtifactIndex.key(self.source_folder)
+        annotated_images = self.artifacts.annotated_sources(self.source_folder) | {
+            os.path.basename(row[0]) for row in self.csv_data.values()
+            if os.path.dirname(ArtifactIndex.key(row[0])) == source_key}
+        scan_index.save()
 
         self.display_image_list = [img for img in self.image_list if img not in annotated_images]
         if not self.display_image_list:
@@ -288,6 +1934,13 @@ class AnnotationTool:
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_release)
         self.canvas.bind("<Button-3>", self.delete_annotation)
+        self.canvas.bind("<Motion>", self.on_motion)
+        self.canvas.bind("<Leave>", lambda e: self.scene.highlight(None))
+        self.scene = CanvasScene(self.canvas)
+        self.name_allocator = FileNameAllocator(self.target_folder)
+        # Older versions kept undone crops in <target>/.trash, where loaders take it for a class
+        shutil.rmtree(os.path.join(self.target_folder, '.trash'), ignore_errors=True)
+        self.taxonomy = TaxonomyIndex(self.target_folder)
 
         self.rect_start = None
         self.current_rect = None
@@ -332,8 +1985,8 @@ class AnnotationTool:
         
         if os.path.exists(storage_path):
             try:
-                with open(storage_path, 'r') as f:
-                    data = json.load(f)
+                journal = self.open_project_store(storage_path)
+                data = journal.load()
                 
                 # Verify the folders still exist
                 source_folder = data.get('source_folder', '')
@@ -348,20 +2001,25 @@ class AnnotationTool:
                 
                 # Load the project data
                 self.annotations = data.get('annotations', {})
-                self.csv_data = data.get('csv_data', [])
+                self.csv_data = csv_rows_by_id(data.get('csv_data', {}))
+                self.next_csv_id = max(self.csv_data, default=-1) + 1
                 self.current_image_index = data.get('current_image_index', 0)
                 self.last_crop = data.get('last_crop', "")
                 self.last_category = data.get('last_category', "")
                 self.last_name = data.get('last_name', "")
+                # The scale older projects were drawn at was never saved, so their boxes stay in canvas pixels
+                self.box_space = data.get('box_space', 'display')
                 self.source_folder = source_folder
                 self.target_folder = target_folder
                 self.selected_source_folder = source_folder
                 self.selected_target_folder = target_folder
                 self.undo_stack = data.get('undo_stack', [])
                 self.redo_stack = data.get('redo_stack', [])
+                self.journal = journal
+                self.register_project(storage_path)
                 
                 # Refresh image lists
-                self.image_list = sorted([f for f in os.listdir(self.source_folder) if f.lower().endswith(('png', 'jpg', 'jpeg'))])
+                self.image_list = self.get_scan_index().source_images()
                 
                 # Filter images with the new function
                 self.display_image_list = self.filter_annotated_images()
@@ -388,68 +2046,54 @@ class AnnotationTool:
 
 
     def delete_annotation(self, event):
-        x_click, y_click = event.x, event.y
+        # The scene keys boxes as (annotation, occurrence); the grid picks the smallest box under the click
+        key = self.scene.box_at(event.x, event.y)
         filename = self.display_image_list[self.current_image_index]
-        if filename in self.annotations:
-            updated_annots = []
-            deleted = False
-            for annot in self.annotations[filename]:
-                x0, y0, x1, y1, crop, category, name, stage = annot
-                
-                if x0 <= x_click <= x1 and y0 <= y_click <= y1 and not deleted:
-                    deleted = True
-                    continue  # skip this one
-                updated_annots.append(annot)
-            if deleted:
-                self.annotations[filename] = updated_annots
-                self.display_image()
+        if key is None or filename not in self.annotations:
+            return
+        removed, occurrence = key
+        annots = self.annotations[filename]
+        for i, annot in enumerate(annots):
+            if tuple(annot) == removed:
+                occurrence -= 1
+                if occurrence == 0:
+                    del annots[i]
+                    self.stats.remove(filename, removed)
+                    self.record_change("delete", [["ann_remove", filename, list(removed)]])
+                    self.refresh_annotations()
+                    return
+
+    def on_motion(self, event):
+        self.scene.highlight(self.scene.box_at(event.x, event.y))
 
     def clear_current_annotations(self):
         if not self.display_image_list:
             return
         filename = self.display_image_list[self.current_image_index]
 
-        # Delete image and text files from all known category/name/stage folders
-        for crop in getattr(self, 'crops', []):
-            crop_path = os.path.join(self.target_folder, crop)
-            if not os.path.exists(crop_path):
-                continue
-
-            for category in os.listdir(crop_path):
-                category_path = os.path.join(crop_path, category)
-                if not os.path.isdir(category_path):
-                    continue
-
-                for name in os.listdir(category_path):
-                    name_path = os.path.join(category_path, name)
-                    if not os.path.isdir(name_path):
-                        continue
-
-                    for stage in os.listdir(name_path):
-                        stage_path = os.path.join(name_path, stage)
-                        images_path = os.path.join(stage_path, 'images')
-                        texts_path = os.path.join(stage_path, 'text_files')
-
-                        # Remove the image file
-                        if os.path.exists(images_path):
-                            img_file_path = os.path.join(images_path, filename)
-                            if os.path.exists(img_file_path):
-                                os.remove(img_file_path)
-
-                        # Remove the text file
-                        if os.path.exists(texts_path):
-                            txt_file_path = os.path.join(texts_path, os.path.splitext(filename)[0] + ".txt")
-                            if os.path.exists(txt_file_path):
-                                os.remove(txt_file_path)
+        # Delete exactly the files written for this image
+        removed_images = set()
+        source_path = os.path.join(self.source_folder, filename)
+        for artifact in self.artifacts.pop(source_path):
+            self.writer.submit({"kind": "delete", "path": artifact["img"]})
+            self.writer.submit({
+                "kind": "remove_box", "path": artifact["txt"], "line": artifact["line"], "box_id": artifact["img"]
+            })
+            removed_images.add(artifact["img"])
 
         # Remove annotations from memory
         if filename in self.annotations:
+            self.stats.clear_image(filename, self.annotations[filename])
             del self.annotations[filename]
             
         # Remove associated CSV entries
-        self.csv_data = [row for row in self.csv_data if not row[0].endswith(filename)]
+        removed_ids = [csv_id for csv_id, row in self.csv_data.items()
+                       if row[1] in removed_images or ArtifactIndex.key(row[0]) == ArtifactIndex.key(source_path)]
+        for csv_id in removed_ids:
+            del self.csv_data[csv_id]
+        self.record_change("clear", [["ann_clear", filename], ["csv_remove", removed_ids]])
 
-        self.display_image()
+        self.refresh_annotations()
 
 
     def clear_root(self):
@@ -483,7 +2127,7 @@ class AnnotationTool:
         if os.path.isdir(self.target_folder):
             for cat in os.listdir(self.target_folder):
                 cat_path = os.path.join(self.target_folder, cat)
-                if os.path.isdir(cat_path):
+                if os.path.isdir(cat_path) and not cat.startswith('.'):
                     self.categories.append(cat)
                     for name in os.listdir(cat_path):
                         name_path = os.path.join(cat_path, name)
@@ -499,73 +2143,123 @@ class AnnotationTool:
         if not self.selected_source_folder or not self.selected_target_folder:
             messagebox.showerror("Error", "Please select both source and target folders.")
             return
+        # Project ids are stable, so these folders may already have a saved project: open it, never overwrite it
+        open_path = getattr(getattr(self, 'journal', None), 'snapshot_path', None)
+        saved_path = self.find_saved_project(self.selected_source_folder, self.selected_target_folder)
+        if saved_path and saved_path != open_path:
+            self.load_specific_project(os.path.basename(saved_path))
+            return
+
         self.source_folder = self.selected_source_folder
         self.target_folder = self.selected_target_folder
+        storage_path = saved_path or self.get_storage_path()
+        if self.use_sqlite_store and not saved_path:
+            storage_path = os.path.splitext(storage_path)[0] + '.sqlite'
+        if storage_path != open_path:
+            # A new project: don't carry over the boxes and history of the one open before
+            self.annotations = {}
+            self.csv_data = {}
+            self.next_csv_id = 0
+            self.undo_stack = []
+            self.redo_stack = []
+            self.current_image_index = 0
+            self.box_space = 'source'
+            self.journal = self.open_project_store(storage_path)
+        self.register_project(storage_path)
         self.setup_page2()
+        # Start the journal from this session's state
+        self.save_to_local_storage(compact=True)
         
     def display_image(self):
-        self.canvas.delete("all")
-        for label in self.annotation_labels:
-            self.canvas.delete(label)
-        self.annotation_labels.clear()
-
         if not self.display_image_list:
+            self.scene.clear_background()
+            self.scene.sync({})
             self.file_name_label.config(text="No images to display")
             return
 
         image_path = os.path.join(self.source_folder, self.display_image_list[self.current_image_index])
-        self.current_image = Image.open(image_path)
+        self.current_image_path = image_path
 
         canvas_width = self.canvas.winfo_width()
         canvas_height = self.canvas.winfo_height()
         if canvas_width <= 1 or canvas_height <= 1:
             canvas_width, canvas_height = 800, 600  # Default fallback
-        img_width, img_height = self.current_image.size
 
-        scale = min(canvas_width / img_width, canvas_height / img_height, 1.0)
-        new_width = max(1, int(img_width * scale))
-        new_height = max(1, int(img_height * scale))
-        resized_image = self.current_image.resize((new_width, new_height), Image.LANCZOS)
+        resized_image, self.display_scale, self.source_size = self.frame_cache.get(image_path, (canvas_width, canvas_height))
+        scale = self.display_scale if self.box_space == 'source' else 1.0
+        if scale != self.view.scale:
+            self.view = ViewTransform(scale)
 
         self.tk_image = ImageTk.PhotoImage(resized_image)
-        self.canvas.create_image(0, 0, anchor="nw", image=self.tk_image)
+        self.scene.set_background(self.tk_image)
         self.file_name_label.config(text=self.display_image_list[self.current_image_index])
 
-        filename = self.display_image_list[self.current_image_index]
-        if filename in self.annotations:
-            for ann in self.annotations[filename]:
-                x0, y0, x1, y1, crop, category, name, stage = ann
-                label_str = f"{crop} | {category} | {name} | {stage}"
-                rect_id = self.canvas.create_rectangle(x0, y0, x1, y1, outline='red', width=2)
-                text_id = self.canvas.create_text(x0 + 5, y0 - 15, anchor="nw", fill="red", text=label_str, font=('Arial', 10, 'bold'))
-                self.annotation_labels.extend([rect_id, text_id])
+        self.refresh_annotations()
+        self.prefetch_neighbours((canvas_width, canvas_height))
 
-    
+    def refresh_annotations(self):
+        """Redraw only the boxes of the current image that changed; the background is left alone."""
+        if self.current_rect:
+            # Drop the rubber-band rectangle left over from drawing
+            self.canvas.delete(self.current_rect)
+            self.current_rect = None
+
+        boxes = {}
+        seen = {}
+        if self.display_image_list:
+            filename = self.display_image_list[self.current_image_index]
+            anns = self.annotations.get(filename, [])
+            view_boxes = np.rint(self.view.to_view([ann[:4] for ann in anns])).astype(int).tolist() if anns else []
+            for ann, coords in zip(anns, view_boxes):
+                crop, category, name, stage = ann[4:8]
+                # Identical boxes are told apart by their occurrence number
+                ann = tuple(ann)
+                seen[ann] = seen.get(ann, 0) + 1
+                boxes[(ann, seen[ann])] = (tuple(coords), f"{crop} | {category} | {name} | {stage}")
+        self.scene.sync(boxes)
         self.update_stats()
 
+    def source_box(self, x0, y0, x1, y1):
+        """Map a stored box to source pixels (plus padding); None means export the full frame."""
+        if not self.crop_export or not self.source_size:
+            return None
+        img_width, img_height = self.source_size
+        scale = (self.display_scale or 1.0) if self.box_space == 'display' else 1.0
+        left = max(0, int(round(min(x0, x1) / scale)) - self.crop_padding)
+        top = max(0, int(round(min(y0, y1) / scale)) - self.crop_padding)
+        right = min(img_width, int(round(max(x0, x1) / scale)) + self.crop_padding)
+        bottom = min(img_height, int(round(max(y0, y1) / scale)) + self.crop_padding)
+        if right <= left or bottom <= top:
+            return None
+        return [left, top, right, bottom]
+
+    def prefetch_neighbours(self, canvas_size):
+        """Queue the next/previous images for background decoding, nearest first."""
+        paths = []
+        for offset in range(1, self.frame_cache.prefetch_depth + 1):
+            for index in (self.current_image_index + offset, self.current_image_index - offset):
+                if 0 <= index < len(self.display_image_list):
+                    paths.append(os.path.join(self.source_folder, self.display_image_list[index]))
+        self.frame_cache.prefetch(paths, canvas_size)
 
     def update_stats(self):
         total_images = len(self.image_list)
         remaining = len(self.display_image_list)
         completed = total_images - remaining
 
-        label_count = {}
-        for anns in self.annotations.values():
-            for ann in anns:
-                label = f"{ann[4]}:{ann[5]}"
-                label_count[label] = label_count.get(label, 0) + 1
-
-        stats = f"✔ {completed}/{total_images} | Labels: {len(label_count)}"
+        stats = f"✔ {completed}/{total_images} | Labels: {len(self.stats.labels)} | Boxes: {self.stats.total}"
         self.stats_label.config(text=stats)
 
     def prev_image(self):
         if self.current_image_index > 0:
             self.current_image_index -= 1
+            self.record_change("nav", [["set", "current_image_index", self.current_image_index]])
             self.display_image()
 
     def next_image(self):
         if self.current_image_index < len(self.display_image_list) - 1:
             self.current_image_index += 1
+            self.record_change("nav", [["set", "current_image_index", self.current_image_index]])
             self.display_image()
 
     def on_press(self, event):
@@ -581,41 +2275,22 @@ class AnnotationTool:
     def on_release(self, event):
         x0, y0 = self.rect_start
         x1, y1 = event.x, event.y
-        self.show_popup(min(x0,x1), min(y0,y1), max(x0,x1), max(y0,y1))
+        # Store the box in the project's coordinate space (source pixels, clipped to the image)
+        box = self.view.to_stored([min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)])[0]
+        if self.box_space == 'source' and self.source_size:
+            box = np.clip(box, 0, [self.source_size[0], self.source_size[1]] * 2)
+        x0, y0, x1, y1 = (int(value) for value in np.rint(box))
+        self.show_popup(x0, y0, x1, y1)
         
     def update_folder_options_from_target(self):
-        crops, names = set(), set()
-        category_stage_map = {}
-        user_categories = set()
-
         if not os.path.exists(self.target_folder):
             return
 
-        for crop in os.listdir(self.target_folder):
-            crop_path = os.path.join(self.target_folder, crop)
-            if not os.path.isdir(crop_path):
-                continue
-            crops.add(crop)
-
-            for category in os.listdir(crop_path):
-                category_path = os.path.join(crop_path, category)
-                if not os.path.isdir(category_path):
-                    continue
-
-                user_categories.add(category.lower())  # Save all found categories
-
-                for name in os.listdir(category_path):
-                    name_path = os.path.join(category_path, name)
-                    if not os.path.isdir(name_path):
-                        continue
-                    names.add(name)
-
-                    for stage in os.listdir(name_path):
-                        if not os.path.isdir(os.path.join(name_path, stage)):
-                            continue
-                        if category.lower() not in category_stage_map:
-                            category_stage_map[category.lower()] = set()
-                        category_stage_map[category.lower()].add(stage)
+        # Served from the in-memory index; the folder tree is only re-checked when a project opens
+        crops = self.taxonomy.crops
+        names = self.taxonomy.names
+        user_categories = self.taxonomy.categories
+        category_stage_map = self.taxonomy.category_stage_map
 
         # Save unique values
         self.crops = sorted(set(getattr(self, 'crops', [])) | crops)
@@ -651,8 +2326,8 @@ class AnnotationTool:
         popup1.configure(bg="#f7fbff")
 
         ttk.Label(popup1, text="Crop:", background="#f7fbff", font=('Arial', 10, 'bold')).pack(anchor='w', padx=10, pady=(10, 0))
-        crop_entry = AutoCompleteEntry(popup1, getattr(self, 'crops', []))
-        
+        crop_entry = AutoCompleteEntry(popup1, getattr(self, 'crops', []), scores=self.suggester.scores("crop"))
+
         crop_entry.pack(padx=10, pady=(0, 10))
 
         category_var = tk.StringVar()
@@ -681,9 +2356,55 @@ class AnnotationTool:
         
         ttk.Label(popup1, text="Name:", background="#f7fbff", font=('Arial', 10, 'bold')).pack(anchor='w', padx=10)
         name_entry = AutoCompleteEntry(popup1, self.names)
-        
         name_entry.pack(padx=10, pady=(0, 10))
 
+        # Pre-select the most likely label; category and name follow the crop until the user picks them
+        picked = {"category": False, "name": False}
+        prefilled_name = [""]
+
+        def select_category(category):
+            if category in sorted_categories:
+                category_var.set(category)
+            else:
+                category_var.set('others')
+                other_category_var.set(category)
+
+        def current_category():
+            category = category_var.get().strip()
+            return other_category_var.get().strip() if category == 'others' else category
+
+        def follow_crop(*args):
+            crop = crop_entry.get().strip()
+            if not picked["category"]:
+                best_category = self.suggester.best("category", crop)
+                if best_category:
+                    select_category(best_category)
+            category = current_category()
+            name_entry.scores = self.suggester.scores("name", crop, category)
+            if not picked["name"] and name_entry.get() == prefilled_name[0]:
+                best_name = self.suggester.best("name", crop, category) or ""
+                if best_name != prefilled_name[0]:
+                    name_entry.set_text(best_name)
+                    prefilled_name[0] = best_name
+
+        def mark_picked(field):
+            picked[field] = True
+
+        crop_entry.set_text(self.last_crop or self.suggester.best("crop") or "")
+        if not self.suggester.best("category", crop_entry.get().strip()) and self.last_category:
+            select_category(self.last_category)
+        follow_crop()
+        if not name_entry.get() and self.last_name:
+            name_entry.set_text(self.last_name)
+            prefilled_name[0] = self.last_name
+        crop_entry.var.trace_add('write', follow_crop)
+        for radio in category_frame.winfo_children():
+            if isinstance(radio, ttk.Radiobutton):
+                radio.configure(command=lambda: (mark_picked("category"), follow_crop()))
+        other_category_entry.bind("<KeyRelease>", lambda e: (mark_picked("category"), follow_crop()))
+        name_entry.bind("<Key>", lambda e: mark_picked("name"), add="+")
+        crop_entry.focus_set()
+
         def next_step():
             
             
@@ -758,6 +2479,14 @@ class AnnotationTool:
                 for opt in options_sorted:
                     ttk.Radiobutton(stage_frame, text=opt, variable=stage_var, value=opt.capitalize()).pack(anchor='w')
 
+                best_stage = self.suggester.best("stage", crop, category, name)
+                if best_stage:
+                    if best_stage in [opt.capitalize() for opt in options_sorted]:
+                        stage_var.set(best_stage)
+                    else:
+                        stage_var.set('other')
+                        other_stage_var.set(best_stage)
+
             render_stage_options()
 
             def save_annotation():
@@ -768,30 +2497,35 @@ class AnnotationTool:
 
                 img_path = os.path.join(self.target_folder, crop, category, name, stage, 'images')
                 txt_path = os.path.join(self.target_folder, crop, category, name, stage, 'text_files')
-                os.makedirs(img_path, exist_ok=True)
-                os.makedirs(txt_path, exist_ok=True)
 
                 filename = self.display_image_list[self.current_image_index]
                 if filename not in self.annotations:
                     self.annotations[filename] = []
 
                 self.annotations[filename].append((x0, y0, x1, y1, crop, category, name, stage))
-                
+                self.stats.add(filename, (x0, y0, x1, y1, crop, category, name, stage))
+                self.suggester.observe(crop, category, name, stage)
 
-                img_name = f"{len(os.listdir(img_path)):04d}.jpg"
+                img_name = self.name_allocator.allocate(img_path)
+                self.taxonomy.add(crop, category, name, stage)
                 img_save_path = os.path.join(img_path, img_name)
-                self.current_image.load()
-                cv2_img = cv2.cvtColor(np.array(self.current_image), cv2.COLOR_RGB2BGR)
-                cv2.imwrite(img_save_path, cv2_img)
+                source_box = self.source_box(x0, y0, x1, y1)
+                self.writer.submit({
+                    "kind": "write_crop", "path": img_save_path,
+                    "source": os.path.join(self.source_folder, filename), "box": source_box
+                })
 
                 txt_name = img_name.replace('.jpg', '.txt')
                 txt_save_path = os.path.join(txt_path, txt_name)
-                with open(txt_save_path, 'a') as f:
-                    f.write(f"{x0},{y0},{x1},{y1}\n")
+                self.writer.submit({
+                    "kind": "append_box", "path": txt_save_path,
+                    "lines": [f"{x0},{y0},{x1},{y1}"], "ids": [img_save_path]
+                })
+                self.artifacts.add(os.path.join(self.source_folder, filename), img_save_path, txt_save_path, f"{x0},{y0},{x1},{y1}")
                 
                 
 
-                self.csv_data.append([
+                csv_id = self.add_csv_row([
                     os.path.join(self.source_folder, filename),
                     img_save_path, crop, category, name, stage, x0, y0, x1, y1
                 ])
@@ -800,13 +2534,23 @@ class AnnotationTool:
                     "annotation": (x0, y0, x1, y1, crop, category, name, stage),
                     "img_path": img_save_path,
                     "txt_path": txt_save_path,
-                    "csv_index": len(self.csv_data) - 1  # Last added row
+                    "source_box": source_box,
+                    "csv_id": csv_id
                 }
                 self.undo_stack.append(action)
                 self.redo_stack.clear()
+                self.record_change("add", [
+                    ["ann_add", filename, [x0, y0, x1, y1, crop, category, name, stage]],
+                    ["csv_add", csv_id, self.csv_data[csv_id]],
+                    ["undo_push", action],
+                    ["redo_clear"],
+                    ["set", "last_crop", crop],
+                    ["set", "last_category", category],
+                    ["set", "last_name", name],
+                ])
 
                 popup2.destroy()
-                self.display_image()
+                self.refresh_annotations()
 
             btn_frame = tk.Frame(popup2, bg="#f7fbff")
             btn_frame.pack(pady=10)
@@ -820,77 +2564,97 @@ class AnnotationTool:
         if not self.undo_stack:
             return
 
-        action = self.undo_stack.pop()
+        action = self.undo_stack[-1]
+        trash_path = self.trash_path(action)  # before any state changes, so a failure leaves nothing half-undone
+        self.undo_stack.pop()
         self.redo_stack.append(action)
 
         filename = action["filename"]
         ann = action["annotation"]
         img_path = action["img_path"]
         txt_path = action["txt_path"]
-        csv_index = action["csv_index"]
 
         # Remove annotation from self.annotations
         if filename in self.annotations:
-            if ann in self.annotations[filename]:
-                self.annotations[filename].remove(ann)
-
-        # Remove saved image
-        if os.path.exists(img_path):
-            os.remove(img_path)
-
-        # Remove corresponding text line
-        if os.path.exists(txt_path):
-            with open(txt_path, 'r') as f:
-                lines = f.readlines()
-            with open(txt_path, 'w') as f:
-                for line in lines:
-                    if line.strip() != f"{ann[0]},{ann[1]},{ann[2]},{ann[3]}":
-                        f.write(line)
+            boxes = self.annotations[filename]
+            for i, box in enumerate(boxes):
+                # Boxes read back from the journal are lists, fresh ones tuples
+                if list(box) == list(ann):
+                    del boxes[i]
+                    self.stats.remove(filename, ann)
+                    break
+        self.suggester.forget(*ann[4:8])
+
+        # Move the saved image to the trash and remove the corresponding text line
+        self.writer.submit({
+            "kind": "trash", "path": img_path, "trash": trash_path,
+            "limit": self.trash_limit_mb * 1024 * 1024
+        })
+        self.writer.submit({
+            "kind": "remove_box", "path": txt_path, "line": f"{ann[0]},{ann[1]},{ann[2]},{ann[3]}", "box_id": img_path
+        })
+        self.artifacts.remove(os.path.join(self.source_folder, filename), img_path)
 
         # Remove row from CSV
-        if 0 <= csv_index < len(self.csv_data):
-            self.csv_data[csv_index] = None  # Mark for removal
-        self.csv_data = [row for row in self.csv_data if row is not None]
-
-        self.display_image()
-        self.unsaved_changes = True 
+        csv_id = action.get("csv_id")
+        if csv_id is None:
+            # Actions saved before rows had ids: find the row by its saved image
+            csv_id = next((key for key, row in self.csv_data.items() if row[1] == img_path), None)
+        self.csv_data.pop(csv_id, None)
+
+        self.record_change("undo", [
+            ["undo_pop"], ["redo_push", action],
+            ["ann_remove", filename, list(ann)], ["csv_remove", [csv_id] if csv_id is not None else []],
+        ])
+        self.refresh_annotations()
     def redo_callback(self, event=None):
         if not self.redo_stack:
             return
 
-        action = self.redo_stack.pop()
+        action = self.redo_stack[-1]
+        trash_path = self.trash_path(action)  # before any state changes, so a failure leaves nothing half-redone
+        claimed = self.reclaim_crop_name(action)
+        self.redo_stack.pop()
         self.undo_stack.append(action)
 
         filename = action["filename"]
         ann = action["annotation"]
         img_path = action["img_path"]
         txt_path = action["txt_path"]
-        csv_index = action["csv_index"]
         crop, category, name, stage = ann[4], ann[5], ann[6], ann[7]
 
         # Reinsert annotation
         if filename not in self.annotations:
             self.annotations[filename] = []
         self.annotations[filename].append(ann)
+        self.stats.add(filename, ann)
+        self.suggester.observe(crop, category, name, stage)
 
-        # Redraw image and re-save it
-        self.current_image.load()
-        cv2_img = cv2.cvtColor(np.array(self.current_image), cv2.COLOR_RGB2BGR)
-        os.makedirs(os.path.dirname(img_path), exist_ok=True)
-        cv2.imwrite(img_path, cv2_img)
+        # Rename the crop back from the trash (re-encoded from the action's own source if evicted)
+        self.writer.submit({
+            "kind": "restore", "path": img_path, "trash": trash_path, "claimed": claimed,
+            "source": os.path.join(self.source_folder, filename),
+            "box": action.get("source_box", self.source_box(*ann[:4]))
+        })
 
         # Re-add bounding box to text file
-        os.makedirs(os.path.dirname(txt_path), exist_ok=True)
-        with open(txt_path, 'a') as f:
-            f.write(f"{ann[0]},{ann[1]},{ann[2]},{ann[3]}\n")
+        self.writer.submit({
+            "kind": "append_box", "path": txt_path, "lines": [f"{ann[0]},{ann[1]},{ann[2]},{ann[3]}"], "ids": [img_path]
+        })
+        self.artifacts.add(os.path.join(self.source_folder, filename), img_path, txt_path, f"{ann[0]},{ann[1]},{ann[2]},{ann[3]}")
 
-        # Re-add CSV row
-        self.csv_data.append([
+        # Re-add CSV row under the action's own id
+        csv_id = self.add_csv_row([
             os.path.join(self.source_folder, filename),
             img_path, crop, category, name, stage, ann[0], ann[1], ann[2], ann[3]
-        ])
+        ], action.get("csv_id"))
+        action["csv_id"] = csv_id
 
-        self.display_image()
+        self.record_change("redo", [
+            ["redo_pop"], ["undo_push", action],
+            ["ann_add", filename, list(ann)], ["csv_add", csv_id, self.csv_data[csv_id]],
+        ])
+        self.refresh_annotations()
 
 
     def update_autocomplete(self, combobox, options):
@@ -907,8 +2671,12 @@ class AnnotationTool:
         if self.unsaved_changes and self.source_folder:
             try:
                 # Minimal save (only writes if changes detected)
-                self.save_to_local_storage()
-                self.unsaved_changes = False
+                saved = self.save_to_local_storage()
+                self.name_allocator.save()
+                self.taxonomy.save()
+                self.artifacts.save()
+                # A save still running keeps the changes pending for the next tick
+                self.unsaved_changes = not saved
             except Exception as e:
                 print(f"Quick-save failed: {e}")
         
@@ -935,9 +2703,24 @@ class AnnotationTool:
         
         # User clicked Yes - proceed with exit
         
-        # 1. Always save current annotations to local storage
+        # 1. Finish pending image/text writes, then save annotations to local storage
+        self.writer.close(timeout=30)
+        if hasattr(self, 'name_allocator'):
+            self.name_allocator.save()
+            self.taxonomy.save()
+            self.artifacts.save()
+        stats = self.writer.stats()
+        if stats["queue_depth"]:
+            messagebox.showwarning(
+                "Pending Writes",
+                f"{stats['queue_depth']} file write(s) did not finish and will be retried on next start."
+            )
+
         try:
-            self.save_to_local_storage()
+            if getattr(self, 'journal', None) is not None:
+                self.journal.wait()
+                self.save_to_local_storage()
+                self.journal.wait()
         except Exception as e:
             messagebox.showerror(
                 "Save Error", 
@@ -945,7 +2728,7 @@ class AnnotationTool:
             )
         
         # 2. Save CSV with user-selected filename if data exists
-        if any(row for row in self.csv_data if row is not None):
+        if self.csv_data:
             # Ask user to select folder and filename
             csv_path = filedialog.asksaveasfilename(
                 title="Save Annotations As",
@@ -964,7 +2747,10 @@ class AnnotationTool:
                             "Category", "Name", "Stage", 
                             "x0", "y0", "x1", "y1"
                         ])
-                        writer.writerows(row for row in self.csv_data if row is not None)
+                        if isinstance(getattr(self, 'journal', None), ProjectStore):
+                            writer.writerows(self.journal.export_rows())
+                        else:
+                            writer.writerows(self.csv_data.values())
                     
                     messagebox.showinfo(
                         "Save Successful",
@@ -977,6 +2763,9 @@ class AnnotationTool:
                     )
         
         # Close the application
+        if isinstance(getattr(self, 'journal', None), ProjectStore):
+            self.journal.close()
+        self.frame_cache.shutdown()
         self.root.destroy()
 
 